@@ -6,7 +6,7 @@ from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
 from sqlalchemy.orm import Session
 from . import models, schemas, crud
-from .database import get_db
+from .database import SessionLocal, get_read_db, is_replica_session
 from .config import settings
 
 # Security configuration
@@ -29,7 +29,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
     encoded_jwt = jwt.encode(to_encode, settings.SECRET_KEY, algorithm=settings.ALGORITHM)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> models.User:
+async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_read_db)) -> models.User:
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
@@ -43,6 +43,10 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     except JWTError:
         raise credentials_exception
     user = crud.get_user_by_username(db, username=username)
+    if user is None and is_replica_session(db):
+        # A user who just registered may not have reached the replica yet
+        with SessionLocal() as primary_db:
+            user = crud.get_user_by_username(primary_db, username=username)
     if user is None:
         raise credentials_exception
     return user
@@ -50,6 +54,11 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
 async def get_current_active_user(current_user: models.User = Depends(get_current_user)) -> models.User:
     return current_user
 
+async def get_current_admin_user(current_user: models.User = Depends(get_current_user)) -> models.User:
+    if current_user.username not in settings.ADMIN_USERNAMES:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Admin access required")
+    return current_user
+
 def decode_token(token: str) -> dict:
     """Decode a JWT token."""
     try:
@@ -1,23 +1,202 @@
-import redis
+import redis.asyncio as redis
 import os
 import json
-from typing import Optional, Any
+from typing import Optional, Any, Dict, Iterable, List, Tuple
+from .config import settings
 
-redis_client = redis.Redis(
+# One pool shared by the whole process; connections are opened lazily on the
+# running event loop
+pool = redis.ConnectionPool(
     host=os.getenv("REDIS_HOST", "redis"),
     port=int(os.getenv("REDIS_PORT", 6379)),
-    db=0,
-    decode_responses=True
+    db=0
 )
+redis_client = redis.Redis(connection_pool=pool)
 
-def get_cache(key: str) -> Optional[Any]:
-    data = redis_client.get(key)
-    if data:
+# Each serializer lists the errors it raises for data it cannot decode, e.g.
+# a value written with another CACHE_SERIALIZER during a rollout
+class JSONSerializer:
+    errors = (ValueError,)
+
+    def dumps(self, value: Any) -> bytes:
+        return json.dumps(value).encode()
+
+    def loads(self, data: bytes) -> Any:
         return json.loads(data)
+
+class OrjsonSerializer:
+    errors = (ValueError,)
+
+    def __init__(self):
+        import orjson
+        self._orjson = orjson
+
+    def dumps(self, value: Any) -> bytes:
+        return self._orjson.dumps(value)
+
+    def loads(self, data: bytes) -> Any:
+        return self._orjson.loads(data)
+
+class MsgpackSerializer:
+    def __init__(self):
+        import msgpack
+        self._msgpack = msgpack
+        self.errors = (ValueError, msgpack.UnpackException)
+
+    def dumps(self, value: Any) -> bytes:
+        return self._msgpack.packb(value, use_bin_type=True)
+
+    def loads(self, data: bytes) -> Any:
+        return self._msgpack.unpackb(data, raw=False)
+
+SERIALIZERS = {
+    "json": JSONSerializer,
+    "orjson": OrjsonSerializer,
+    "msgpack": MsgpackSerializer,
+}
+
+def get_serializer(name: str):
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown cache serializer: {name}")
+    return SERIALIZERS[name]()
+
+serializer = get_serializer(settings.CACHE_SERIALIZER)
+
+_UNDECODABLE = object()
+
+def _loads(data: bytes) -> Any:
+    try:
+        return serializer.loads(data)
+    except serializer.errors:
+        return _UNDECODABLE
+
+def _loads_list(data: List[bytes]) -> Optional[List[Any]]:
+    values = [_loads(item) for item in data]
+    if any(value is _UNDECODABLE for value in values):
+        return None
+    return values
+
+async def get_cache(key: str) -> Optional[Any]:
+    """Cached value, or None if missing; a value that cannot be decoded is deleted and treated as missing."""
+    data = await redis_client.get(key)
+    if data:
+        value = _loads(data)
+        if value is not _UNDECODABLE:
+            return value
+        await delete_cache(key)
+    return None
+
+async def get_many_cache(keys: List[str]) -> List[Optional[Any]]:
+    """Fetch several keys in one round trip; missing keys come back as None."""
+    if not keys:
+        return []
+    values = [_loads(data) if data else None for data in await redis_client.mget(keys)]
+    await delete_cache(*(key for key, value in zip(keys, values) if value is _UNDECODABLE))
+    return [None if value is _UNDECODABLE else value for value in values]
+
+async def set_cache(key: str, value: Any, expire: int = 3600) -> None:
+    await redis_client.setex(key, expire, serializer.dumps(value))
+
+async def set_many_cache(values: Dict[str, Any], expire: int = 3600) -> None:
+    """Set several keys with the same expiry in one pipelined round trip."""
+    if not values:
+        return
+    async with redis_client.pipeline(transaction=False) as pipe:
+        for key, value in values.items():
+            pipe.setex(key, expire, serializer.dumps(value))
+        await pipe.execute()
+
+async def delete_cache(*keys: str) -> None:
+    if keys:
+        await redis_client.delete(*keys)
+
+async def invalidate_prefix(prefix: str, batch_size: int = 500) -> None:
+    """Delete every key starting with prefix, scanning instead of blocking Redis with KEYS."""
+    batch = []
+    async for key in redis_client.scan_iter(match=f"{prefix}*", count=batch_size):
+        batch.append(key)
+        if len(batch) >= batch_size:
+            await redis_client.unlink(*batch)
+            batch = []
+    if batch:
+        await redis_client.unlink(*batch)
+
+async def push_capped_list(key: str, value: Any, maxlen: int, expire: int = 3600, count_key: Optional[str] = None) -> None:
+    """Append to an existing list, keeping only its newest maxlen entries.
+
+    Nothing is written if the list does not exist yet, so a partial list is
+    never created behind the back of whoever fills it. With count_key, a
+    counter of everything ever appended is bumped along with it.
+    """
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.rpushx(key, serializer.dumps(value))
+        pipe.ltrim(key, -maxlen, -1)
+        pipe.expire(key, expire)
+        if count_key:
+            pipe.incr(count_key)
+            pipe.expire(count_key, expire)
+        await pipe.execute()
+
+async def replace_list(
+    key: str,
+    values: Iterable[Any],
+    expire: int = 3600,
+    count_key: Optional[str] = None,
+    count: Optional[int] = None
+) -> None:
+    """Replace a list, and with count_key set its counter to count."""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.delete(key)
+        encoded = [serializer.dumps(value) for value in values]
+        if encoded:
+            pipe.rpush(key, *encoded)
+            pipe.expire(key, expire)
+        if count_key:
+            pipe.set(count_key, count if count is not None else len(encoded), ex=expire)
+        await pipe.execute()
+
+async def get_list(key: str) -> Optional[List[Any]]:
+    data = await redis_client.lrange(key, 0, -1)
+    if data:
+        values = _loads_list(data)
+        if values is not None:
+            return values
+        await delete_cache(key)
     return None
 
-def set_cache(key: str, value: Any, expire: int = 3600) -> None:
-    redis_client.setex(key, expire, json.dumps(value))
+async def get_counted_list(key: str, count_key: str) -> Tuple[Optional[List[Any]], Optional[int]]:
+    """A list and its counter (see push_capped_list), read in one round trip."""
+    async with redis_client.pipeline(transaction=True) as pipe:
+        pipe.lrange(key, 0, -1)
+        pipe.get(count_key)
+        data, count = await pipe.execute()
+    values = _loads_list(data) if data else None
+    if data and values is None:
+        await delete_cache(key, count_key)
+        return None, None
+    return values, int(count) if count is not None else None
+
+# Leases: a key owned by one process at a time, renewed while it is alive
+_RENEW_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('pexpire', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+_RELEASE_LEASE_SCRIPT = """
+if redis.call('get', KEYS[1]) == ARGV[1] then
+    return redis.call('del', KEYS[1])
+end
+return 0
+"""
+
+async def acquire_lease(key: str, owner: str, ttl_ms: int) -> bool:
+    return bool(await redis_client.set(key, owner, nx=True, px=ttl_ms))
+
+async def renew_lease(key: str, owner: str, ttl_ms: int) -> bool:
+    """Extend the lease, but only if owner still holds it."""
+    return bool(await redis_client.eval(_RENEW_LEASE_SCRIPT, 1, key, owner, ttl_ms))
 
-def delete_cache(key: str) -> None:
-    redis_client.delete(key) 
\ No newline at end of file
+async def release_lease(key: str, owner: str) -> None:
+    await redis_client.eval(_RELEASE_LEASE_SCRIPT, 1, key, owner)
@@ -0,0 +1,246 @@
+from pathlib import Path
+from sqlalchemy import LargeBinary, String
+from sqlalchemy.types import TypeDecorator
+from typing import Dict, Optional
+import base64
+import logging
+import struct
+import threading
+import zlib
+from .config import settings
+
+try:
+    import zstandard
+except ImportError:  # Optional: without it new values are compressed with zlib
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+class CodecUnavailableError(ValueError):
+    """A value names a codec or dictionary this process doesn't have."""
+
+# Errors from decoding something that turns out not to be compressed
+_DECODE_ERRORS = (ValueError, struct.error, zlib.error) + ((zstandard.ZstdError,) if zstandard is not None else ())
+
+# Stored format: a version byte saying how the rest was encoded, so rows
+# written by older versions (or before compression existed) stay readable
+#   RAW        payload as is; only used to escape values that look compressed
+#   ZLIB       zlib stream
+#   ZSTD       zstd frame
+#   ZSTD_DICT  4-byte dictionary ID, then a zstd frame made with that dictionary
+RAW = 0
+ZLIB = 1
+ZSTD = 2
+ZSTD_DICT = 3
+
+# Binary values start with MAGIC, then the version byte. Media written before
+# compression doesn't start with it, so it is returned as it is
+MAGIC = b"\x89CMP"
+
+# Text values are kept as text: TEXT_MARKER, then the version byte and
+# payload in base85. Text without the marker is plain
+TEXT_MARKER = "\x01"
+
+# Leading bytes of formats that are already compressed, not worth another pass
+COMPRESSED_SIGNATURES = (
+    b"\xff\xd8\xff",        # JPEG
+    b"\x89PNG",             # PNG
+    b"GIF8",                # GIF
+    b"\x1a\x45\xdf\xa3",    # WebM / Matroska
+    b"OggS",                # Ogg (Opus, Vorbis)
+    b"ID3", b"\xff\xfb", b"\xff\xf3", b"\xff\xf2",  # MP3
+    b"fLaC",                # FLAC
+    b"PK\x03\x04",          # ZIP
+    b"\x1f\x8b",            # gzip
+    b"\x28\xb5\x2f\xfd",    # zstd
+)
+
+_local = threading.local()
+_dictionaries: Optional[Dict[int, "zstandard.ZstdCompressionDict"]] = None
+_dictionaries_lock = threading.Lock()
+
+def is_compressed_format(data: bytes) -> bool:
+    """Whether data is a media format that is compressed already."""
+    if data.startswith(COMPRESSED_SIGNATURES):
+        return True
+    # RIFF containers: WebP is compressed, WAV is not
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return True
+    # MP4 / M4A / MOV
+    return data[4:8] == b"ftyp"
+
+def load_dictionaries() -> Dict[int, "zstandard.ZstdCompressionDict"]:
+    """zstd dictionaries in COMPRESSION_DICTIONARY_DIR, by dictionary ID."""
+    global _dictionaries
+    if _dictionaries is None:
+        with _dictionaries_lock:
+            if _dictionaries is None:
+                dictionaries = {}
+                if zstandard is not None and settings.COMPRESSION_DICTIONARY_DIR:
+                    for path in sorted(Path(settings.COMPRESSION_DICTIONARY_DIR).glob("*.zdict")):
+                        dictionary = zstandard.ZstdCompressionDict(path.read_bytes())
+                        dictionaries[dictionary.dict_id()] = dictionary
+                _dictionaries = dictionaries
+    return _dictionaries
+
+def _compressor(dictionary_id: int = 0):
+    # zstd (de)compressors are not thread safe, so each thread gets its own
+    compressors = getattr(_local, "compressors", None)
+    if compressors is None:
+        compressors = _local.compressors = {}
+    if dictionary_id not in compressors:
+        dictionary = load_dictionaries()[dictionary_id] if dictionary_id else None
+        # The version byte already says which dictionary; for short texts the
+        # frame's own dictionary ID and checksum would cost more than they save
+        compressors[dictionary_id] = zstandard.ZstdCompressor(
+            level=settings.COMPRESSION_LEVEL, dict_data=dictionary, write_dict_id=False, write_checksum=False
+        )
+    return compressors[dictionary_id]
+
+def _decompressor(dictionary_id: int = 0):
+    decompressors = getattr(_local, "decompressors", None)
+    if decompressors is None:
+        decompressors = _local.decompressors = {}
+    if dictionary_id not in decompressors:
+        if zstandard is None:
+            raise CodecUnavailableError("zstandard is required to read values compressed with zstd")
+        dictionary = None
+        if dictionary_id:
+            dictionary = load_dictionaries().get(dictionary_id)
+            if dictionary is None:
+                raise CodecUnavailableError(f"zstd dictionary {dictionary_id} not found in {settings.COMPRESSION_DICTIONARY_DIR!r}")
+        decompressors[dictionary_id] = zstandard.ZstdDecompressor(dict_data=dictionary)
+    return decompressors[dictionary_id]
+
+def current_version(use_dictionary: bool = False) -> int:
+    """The version new values are written with."""
+    if settings.COMPRESSION_CODEC == "zstd" and zstandard is not None:
+        if use_dictionary and settings.COMPRESSION_DICTIONARY_ID:
+            return ZSTD_DICT
+        return ZSTD
+    return ZLIB
+
+def pack(data: bytes, use_dictionary: bool = False) -> bytes:
+    """Compress data into version byte + payload."""
+    version = current_version(use_dictionary)
+    if version == ZSTD_DICT:
+        dictionary_id = settings.COMPRESSION_DICTIONARY_ID
+        return bytes([ZSTD_DICT]) + struct.pack(">I", dictionary_id) + _compressor(dictionary_id).compress(data)
+    if version == ZSTD:
+        return bytes([ZSTD]) + _compressor().compress(data)
+    return bytes([ZLIB]) + zlib.compress(data, settings.COMPRESSION_LEVEL)
+
+def unpack(blob: bytes, escaped_prefix: bytes) -> bytes:
+    """Decode version byte + payload; RAW payloads must start with escaped_prefix."""
+    if len(blob) < 2:
+        raise ValueError("Compressed value too short")
+    version = blob[0]
+    if version == RAW:
+        # Only values that would otherwise look compressed are escaped
+        if not blob[1:].startswith(escaped_prefix):
+            raise ValueError("Escaped value without its prefix")
+        return blob[1:]
+    if version == ZLIB:
+        return zlib.decompress(blob[1:])
+    if version == ZSTD:
+        return _decompressor().decompress(blob[1:])
+    if version == ZSTD_DICT:
+        if len(blob) < 6:
+            raise ValueError("Compressed value too short")
+        dictionary_id, = struct.unpack(">I", blob[1:5])
+        return _decompressor(dictionary_id).decompress(blob[5:])
+    raise ValueError(f"Unknown compression format version {version}")
+
+def stored_version(value) -> Optional[int]:
+    """Format version of a stored value, or None if it is stored uncompressed."""
+    if isinstance(value, str):
+        if not value.startswith(TEXT_MARKER):
+            return None
+        try:
+            return base64.b85decode(value[1:6])[0]
+        except (ValueError, IndexError):
+            return None
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        value = bytes(value)
+        if value.startswith(MAGIC) and len(value) > len(MAGIC):
+            return value[len(MAGIC)]
+    return None
+
+def compress_text(value: Optional[str]) -> Optional[str]:
+    if value is None or not settings.COMPRESSION_ENABLED:
+        return value
+    raw = value.encode("utf-8")
+    # With a dictionary trained on our messages even short texts shrink
+    use_dictionary = current_version(use_dictionary=True) == ZSTD_DICT
+    threshold = settings.COMPRESSION_MIN_DICTIONARY_TEXT_BYTES if use_dictionary else settings.COMPRESSION_MIN_TEXT_BYTES
+    if len(raw) >= threshold:
+        encoded = TEXT_MARKER + base64.b85encode(pack(raw, use_dictionary)).decode("ascii")
+        if len(encoded) <= len(raw) * (1 - settings.COMPRESSION_MIN_SAVINGS):
+            return encoded
+    if value.startswith(TEXT_MARKER):
+        # Escape text that would otherwise be read back as compressed
+        return TEXT_MARKER + base64.b85encode(bytes([RAW]) + raw).decode("ascii")
+    return value
+
+def _log_undecodable(error: Exception) -> None:
+    # Most likely a legacy value, but a missing dictionary is a misconfiguration
+    if isinstance(error, CodecUnavailableError):
+        logger.warning("Returning a value as stored: %s", error)
+
+def decompress_text(value: Optional[str]) -> Optional[str]:
+    if value is None or not value.startswith(TEXT_MARKER):
+        return value
+    try:
+        return unpack(base64.b85decode(value[1:]), TEXT_MARKER.encode("utf-8")).decode("utf-8")
+    except _DECODE_ERRORS as e:
+        # Plain text from before compression that happens to start with the
+        # marker, or a value this process can't decode
+        _log_undecodable(e)
+        return value
+
+def compress_bytes(value: Optional[bytes]) -> Optional[bytes]:
+    if value is None:
+        return value
+    value = bytes(value)
+    if settings.COMPRESSION_ENABLED and len(value) >= settings.COMPRESSION_MIN_MEDIA_BYTES and not is_compressed_format(value):
+        packed = MAGIC + pack(value)
+        if len(packed) <= len(value) * (1 - settings.COMPRESSION_MIN_SAVINGS):
+            return packed
+    if value.startswith(MAGIC):
+        return MAGIC + bytes([RAW]) + value
+    return value
+
+def decompress_bytes(value: Optional[bytes]) -> Optional[bytes]:
+    if value is None:
+        return value
+    value = bytes(value)
+    if not value.startswith(MAGIC) or len(value) <= len(MAGIC):
+        return value
+    try:
+        return unpack(value[len(MAGIC):], MAGIC)
+    except _DECODE_ERRORS as e:
+        # Media from before compression that happens to start with MAGIC
+        _log_undecodable(e)
+        return value
+
+class CompressedText(TypeDecorator):
+    """Text column compressed transparently above COMPRESSION_MIN_TEXT_BYTES."""
+    impl = String
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return compress_text(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_text(value)
+
+class CompressedBinary(TypeDecorator):
+    """Binary column compressed transparently unless the data is a compressed format already."""
+    impl = LargeBinary
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return compress_bytes(value)
+
+    def process_result_value(self, value, dialect):
+        return decompress_bytes(value)
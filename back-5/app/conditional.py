@@ -0,0 +1,48 @@
+from fastapi import Request, Response, status
+from typing import Any, Optional
+import hashlib
+
+# Authenticated responses must never be shared between users, and clients
+# should always revalidate because the watermark check is cheap.
+PRIVATE_CACHE_CONTROL = "private, no-cache"
+PUBLIC_CACHE_CONTROL = "public, no-cache"
+
+def make_etag(*parts: Any) -> str:
+    """Build a weak ETag from watermark values instead of the response body."""
+    raw = "|".join("" if part is None else str(part) for part in parts)
+    digest = hashlib.blake2b(raw.encode(), digest_size=12).hexdigest()
+    return f'W/"{digest}"'
+
+def etag_matches(request: Request, etag: str) -> bool:
+    """Check If-None-Match using the weak comparison required for GET."""
+    header = request.headers.get("if-none-match")
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    opaque = etag[2:] if etag.startswith("W/") else etag
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/"):
+            candidate = candidate[2:]
+        if candidate == opaque:
+            return True
+    return False
+
+def cache_headers(etag: str, private: bool = True) -> dict:
+    """Validator and caching headers shared by 200 and 304 responses."""
+    headers = {
+        "ETag": etag,
+        "Cache-Control": PRIVATE_CACHE_CONTROL if private else PUBLIC_CACHE_CONTROL,
+    }
+    if private:
+        headers["Vary"] = "Authorization"
+    return headers
+
+def not_modified_response(request: Request, response: Response, etag: str, private: bool = True) -> Optional[Response]:
+    """Return a 304 if the client already has this version, otherwise tag the response."""
+    headers = cache_headers(etag, private=private)
+    if etag_matches(request, etag):
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    response.headers.update(headers)
+    return None
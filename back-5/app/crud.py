@@ -1,14 +1,22 @@
+from sqlalchemy import LargeBinary, String, func, or_, select, type_coerce, update
 from sqlalchemy.orm import Session
-from . import models, schemas, auth
-from .cache import get_cache, set_cache, delete_cache
-from typing import List, Optional
-from datetime import datetime
+from . import models, schemas, auth, compression
+from .cache import get_cache, set_cache, delete_cache, push_capped_list, replace_list, get_counted_list
+from .config import settings
+from .database import is_replica_session
+from typing import List, Optional, Union
+from datetime import datetime, timezone
+from redis.exceptions import RedisError
+import asyncio
 import os
 import base64
+import logging
 from fastapi import UploadFile
 import aiofiles
 import magic
 
+logger = logging.getLogger(__name__)
+
 # User operations
 def get_user(db: Session, user_id: int) -> Optional[models.User]:
     return db.query(models.User).filter(models.User.id == user_id).first()
@@ -20,7 +28,34 @@ def get_user_by_username(db: Session, username: str) -> Optional[models.User]:
     return db.query(models.User).filter(models.User.username == username).first()
 
 def get_users(db: Session, skip: int = 0, limit: int = 100) -> List[models.User]:
-    return db.query(models.User).offset(skip).limit(limit).all()
+    return db.query(models.User).order_by(models.User.id).offset(skip).limit(limit).all()
+
+def _prefix_key(db: Session, column):
+    key = func.lower(column)
+    if db.get_bind().dialect.name == "postgresql":
+        key = key.collate("C")
+    return key
+
+def search_users(db: Session, query: str, limit: int = 10) -> List[tuple]:
+    """(id, username) of users whose username or email starts with query, case-insensitively.
+
+    Each column is searched as a range on its lower() index, ordered by the
+    index and cut at limit, so the cost does not grow with the number of users.
+    """
+    prefix = query.strip().lower()
+    if not prefix:
+        return []
+    # Smallest string greater than every string starting with prefix
+    upper = prefix[:-1] + chr(min(ord(prefix[-1]) + 1, 0x10FFFF))
+    results = {}
+    for column in (models.User.username, models.User.email):
+        key = _prefix_key(db, column)
+        rows = db.query(models.User.id, models.User.username).filter(
+            key >= prefix, key < upper
+        ).order_by(key).limit(limit).all()
+        for row in rows:
+            results.setdefault(row.id, row)
+    return list(results.values())[:limit]
 
 def create_user(db: Session, user: schemas.UserCreate) -> models.User:
     hashed_password = auth.get_password_hash(user.password)
@@ -45,7 +80,7 @@ def authenticate_user(db: Session, username: str, password: str) -> Optional[mod
     return user
 
 # Message operations
-def create_message(db: Session, message: schemas.MessageCreate, sender_id: int) -> models.Message:
+async def create_message(db: Session, message: schemas.MessageCreate, sender_id: int) -> models.Message:
     # Accept both enum and string for message_type
     if isinstance(message.message_type, models.MessageType):
         msg_type = message.message_type
@@ -61,6 +96,7 @@ def create_message(db: Session, message: schemas.MessageCreate, sender_id: int)
     db.add(db_message)
     db.commit()
     db.refresh(db_message)
+    await cache_new_message(db_message)
     return db_message
 
 def get_user_messages(db: Session, user_id: int, skip: int = 0, limit: int = 100) -> List[models.Message]:
@@ -68,36 +104,448 @@ def get_user_messages(db: Session, user_id: int, skip: int = 0, limit: int = 100
         (models.Message.sender_id == user_id) | (models.Message.receiver_id == user_id)
     ).order_by(models.Message.created_at.desc()).offset(skip).limit(limit).all()
 
+def get_message(db: Session, message_id: int) -> Optional[models.Message]:
+    return db.query(models.Message).filter(models.Message.id == message_id).first()
+
+def iter_user_messages(
+    db: Session,
+    user_id: int,
+    other_user_id: Optional[int] = None,
+    after_id: int = 0,
+    batch_size: int = 1000
+):
+    """Iterate over a user's messages in ID order from a server-side cursor.
+
+    Rows are projections without the media blob; has_media tells whether one exists.
+    Pass the last ID seen as after_id to resume.
+    """
+    query = db.query(
+        models.Message.id,
+        models.Message.sender_id,
+        models.Message.receiver_id,
+        models.Message.message_type,
+        models.Message.content,
+        models.Message.created_at,
+        models.Message.media_data.isnot(None).label("has_media")
+    ).filter(models.Message.id > after_id)
+    if other_user_id is None:
+        query = query.filter((models.Message.sender_id == user_id) | (models.Message.receiver_id == user_id))
+    else:
+        query = query.filter(
+            ((models.Message.sender_id == user_id) & (models.Message.receiver_id == other_user_id)) |
+            ((models.Message.sender_id == other_user_id) & (models.Message.receiver_id == user_id))
+        )
+    # yield_per also turns on stream_results, so rows are fetched in batches
+    return query.order_by(models.Message.id).yield_per(batch_size)
+
 def get_messages_between_users(db: Session, user1_id: int, user2_id: int, skip: int = 0, limit: int = 100) -> List[models.Message]:
-    """Get messages between two specific users."""
+    """Get messages between two specific users, oldest first.
+
+    Ordered by ID, not created_at: on Postgres created_at is the start of the
+    writing transaction, which can be older than a message committed before it.
+    """
     return db.query(models.Message).filter(
         ((models.Message.sender_id == user1_id) & (models.Message.receiver_id == user2_id)) |
         ((models.Message.sender_id == user2_id) & (models.Message.receiver_id == user1_id))
-    ).order_by(models.Message.created_at.asc()).offset(skip).limit(limit).all()
+    ).order_by(models.Message.id.asc()).offset(skip).limit(limit).all()
+
+# Scheduled message operations
+def _as_utc(value: datetime) -> datetime:
+    # SQLite hands back naive datetimes; everything is stored in UTC
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def create_scheduled_message(db: Session, message: schemas.ScheduledMessageCreate, sender_id: int) -> models.ScheduledMessage:
+    db_scheduled = models.ScheduledMessage(
+        sender_id=sender_id,
+        receiver_id=message.receiver_id,
+        content=message.content,
+        due_at=_as_utc(message.due_at),
+        status=models.ScheduledMessageStatus.PENDING
+    )
+    db.add(db_scheduled)
+    db.commit()
+    db.refresh(db_scheduled)
+    return db_scheduled
+
+def get_pending_scheduled_messages(db: Session, sender_id: int, skip: int = 0, limit: int = 100) -> List[models.ScheduledMessage]:
+    return db.query(models.ScheduledMessage).filter(
+        models.ScheduledMessage.sender_id == sender_id,
+        models.ScheduledMessage.status == models.ScheduledMessageStatus.PENDING
+    ).order_by(models.ScheduledMessage.due_at).offset(skip).limit(limit).all()
+
+def cancel_scheduled_message(db: Session, scheduled_id: int, sender_id: int) -> bool:
+    cancelled = db.query(models.ScheduledMessage).filter(
+        models.ScheduledMessage.id == scheduled_id,
+        models.ScheduledMessage.sender_id == sender_id,
+        models.ScheduledMessage.status == models.ScheduledMessageStatus.PENDING
+    ).update({models.ScheduledMessage.status: models.ScheduledMessageStatus.CANCELLED}, synchronize_session=False)
+    db.commit()
+    return cancelled > 0
+
+def get_upcoming_scheduled_messages(
+    db: Session,
+    until: datetime,
+    loaded_until: Optional[datetime] = None,
+    after_id: int = 0
+) -> List[tuple]:
+    """(id, due_at) of pending messages due by `until`.
+
+    With loaded_until, only those due after it or created after after_id are
+    returned, so the scheduler can load just what it has not seen yet.
+    """
+    query = db.query(models.ScheduledMessage.id, models.ScheduledMessage.due_at).filter(
+        models.ScheduledMessage.status == models.ScheduledMessageStatus.PENDING,
+        models.ScheduledMessage.due_at <= _as_utc(until)
+    )
+    if loaded_until is not None:
+        query = query.filter(or_(
+            models.ScheduledMessage.due_at > _as_utc(loaded_until),
+            models.ScheduledMessage.id > after_id
+        ))
+    return [(row.id, _as_utc(row.due_at)) for row in query.all()]
+
+def deliver_scheduled_message(db: Session, scheduled_id: int) -> Optional[models.Message]:
+    """Turn a pending scheduled message into a Message, exactly once.
+
+    The status flip and the insert share one transaction, so a message that
+    lost the race (cancelled, or delivered by another owner) is never stored.
+    """
+    claimed = db.query(models.ScheduledMessage).filter(
+        models.ScheduledMessage.id == scheduled_id,
+        models.ScheduledMessage.status == models.ScheduledMessageStatus.PENDING
+    ).update({models.ScheduledMessage.status: models.ScheduledMessageStatus.DELIVERED}, synchronize_session=False)
+    if not claimed:
+        db.rollback()
+        return None
+    scheduled = db.query(models.ScheduledMessage).filter(models.ScheduledMessage.id == scheduled_id).one()
+    db_message = models.Message(
+        sender_id=scheduled.sender_id,
+        receiver_id=scheduled.receiver_id,
+        message_type=models.MessageType.TEXT,
+        content=scheduled.content
+    )
+    db.add(db_message)
+    db.flush()
+    scheduled.message_id = db_message.id
+    db.commit()
+    db.refresh(db_message)
+    return db_message
+
+def create_upload_session(
+    db: Session,
+    upload: schemas.UploadCreate,
+    upload_id: str,
+    user_id: int,
+    message_type: models.MessageType
+) -> models.UploadSession:
+    db_upload = models.UploadSession(
+        id=upload_id,
+        user_id=user_id,
+        receiver_id=upload.receiver_id,
+        filename=upload.filename,
+        content_type=upload.content_type,
+        message_type=message_type,
+        size=upload.size,
+        offset=0,
+        status=models.UploadStatus.ACTIVE
+    )
+    db.add(db_upload)
+    db.commit()
+    db.refresh(db_upload)
+    return db_upload
+
+def get_upload_session(db: Session, upload_id: str, user_id: int) -> Optional[models.UploadSession]:
+    return db.query(models.UploadSession).filter(
+        models.UploadSession.id == upload_id,
+        models.UploadSession.user_id == user_id
+    ).first()
+
+def count_active_uploads(db: Session, user_id: int, since: datetime) -> int:
+    """Uploads of a user still in progress, i.e. written to after `since`."""
+    return db.query(func.count(models.UploadSession.id)).filter(
+        models.UploadSession.user_id == user_id,
+        models.UploadSession.status == models.UploadStatus.ACTIVE,
+        models.UploadSession.updated_at >= _as_utc(since)
+    ).scalar()
+
+def claim_upload_writer(db: Session, upload_id: str, offset: int, writer: str, stale_before: datetime) -> bool:
+    """Claim the right to write the chunk at `offset`, unless another request holds it.
+
+    A claim made before `stale_before` belongs to a request that died
+    without releasing it, and is taken over.
+    """
+    claimed = db.query(models.UploadSession).filter(
+        models.UploadSession.id == upload_id,
+        models.UploadSession.status == models.UploadStatus.ACTIVE,
+        models.UploadSession.offset == offset,
+        or_(models.UploadSession.writer.is_(None), models.UploadSession.writer_claimed_at < _as_utc(stale_before))
+    ).update({
+        models.UploadSession.writer: writer,
+        models.UploadSession.writer_claimed_at: datetime.now(timezone.utc)
+    }, synchronize_session=False)
+    db.commit()
+    return claimed > 0
+
+def holds_upload_writer(db: Session, upload_id: str, writer: str) -> bool:
+    return db.query(models.UploadSession.id).filter(
+        models.UploadSession.id == upload_id,
+        models.UploadSession.writer == writer
+    ).first() is not None
+
+def release_upload_writer(db: Session, upload_id: str, writer: str) -> None:
+    db.query(models.UploadSession).filter(
+        models.UploadSession.id == upload_id,
+        models.UploadSession.writer == writer
+    ).update({models.UploadSession.writer: None}, synchronize_session=False)
+    db.commit()
+
+def advance_upload_offset(db: Session, upload_id: str, offset: int, new_offset: int, writer: str) -> bool:
+    """Move an upload's offset forward and release the claim, only if `writer` still holds it at `offset`."""
+    advanced = db.query(models.UploadSession).filter(
+        models.UploadSession.id == upload_id,
+        models.UploadSession.status == models.UploadStatus.ACTIVE,
+        models.UploadSession.offset == offset,
+        models.UploadSession.writer == writer
+    ).update({models.UploadSession.offset: new_offset, models.UploadSession.writer: None}, synchronize_session=False)
+    db.commit()
+    return advanced > 0
+
+def complete_upload_session(db: Session, upload_id: str, content: str) -> Optional[models.Message]:
+    """Create the Message for a fully received upload, exactly once.
+
+    Like deliver_scheduled_message, the status flip and the insert share one
+    transaction; None means another request completed the upload first.
+    """
+    claimed = db.query(models.UploadSession).filter(
+        models.UploadSession.id == upload_id,
+        models.UploadSession.status == models.UploadStatus.ACTIVE,
+        models.UploadSession.offset == models.UploadSession.size
+    ).update({models.UploadSession.status: models.UploadStatus.COMPLETED}, synchronize_session=False)
+    if not claimed:
+        db.rollback()
+        return None
+    upload = db.query(models.UploadSession).filter(models.UploadSession.id == upload_id).one()
+    # The file is served from the media directory by name, not stored in the row
+    db_message = models.Message(
+        sender_id=upload.user_id,
+        receiver_id=upload.receiver_id,
+        message_type=upload.message_type,
+        content=content
+    )
+    db.add(db_message)
+    db.flush()
+    upload.message_id = db_message.id
+    db.commit()
+    db.refresh(db_message)
+    return db_message
+
+def recompress_messages(db: Session, after_id: int, batch_size: int) -> tuple[Optional[int], int]:
+    """Rewrite the next batch of messages after after_id not stored in the current compressed format.
+
+    Covers rows written before compression, with older settings or with zlib
+    before zstandard was installed. Returns (last ID in the batch or None if
+    there are no more, rows rewritten).
+    """
+    messages = models.Message.__table__
+    # Raw stored values: type_coerce skips the decompression of the column types.
+    # Of media only the first bytes are read, enough to tell its format
+    rows = db.execute(
+        select(
+            messages.c.id,
+            type_coerce(messages.c.content, String).label("content"),
+            type_coerce(func.substr(messages.c.media_data, 1, 16), LargeBinary).label("media_head"),
+            func.length(messages.c.media_data).label("media_length")
+        ).where(messages.c.id > after_id).order_by(messages.c.id).limit(batch_size)
+    ).all()
+    if not rows:
+        return None, 0
+
+    rewritten = 0
+    for row in rows:
+        values = {}
+        if row.content is not None:
+            content = compression.decompress_text(row.content)
+            if compression.compress_text(content) != row.content:
+                values["content"] = content
+        if row.media_head is not None and _media_needs_recompression(bytes(row.media_head), row.media_length):
+            stored = bytes(db.execute(
+                select(type_coerce(messages.c.media_data, LargeBinary)).where(messages.c.id == row.id)
+            ).scalar())
+            media_data = compression.decompress_bytes(stored)
+            # Incompressible data stays as it is
+            if compression.compress_bytes(media_data) != stored:
+                values["media_data"] = media_data
+        if values:
+            db.execute(update(messages).where(messages.c.id == row.id).values(**values))
+            rewritten += 1
+    db.commit()
+    return rows[-1].id, rewritten
+
+def _media_needs_recompression(head: bytes, length: int) -> bool:
+    if head.startswith(compression.MAGIC):
+        version = head[len(compression.MAGIC)]
+        return version != compression.RAW and version != compression.current_version()
+    return length >= settings.COMPRESSION_MIN_MEDIA_BYTES and not compression.is_compressed_format(head)
+
+def delete_stale_upload_sessions(db: Session, before: datetime) -> List[str]:
+    """Delete upload sessions not touched since `before`; returns the IDs of the unfinished ones."""
+    stale = db.query(models.UploadSession.id, models.UploadSession.status).filter(
+        models.UploadSession.updated_at < _as_utc(before)
+    ).all()
+    if not stale:
+        return []
+    db.query(models.UploadSession).filter(
+        models.UploadSession.id.in_([row.id for row in stale]),
+        models.UploadSession.updated_at < _as_utc(before)
+    ).delete(synchronize_session=False)
+    db.commit()
+    return [row.id for row in stale if row.status == models.UploadStatus.ACTIVE]
+
+# Hot-message cache: the newest MESSAGE_CACHE_SIZE serialized messages of each
+# conversation in a capped Redis list, written through on create
+def _conversation_cache_key(user1_id: int, user2_id: int) -> str:
+    low, high = sorted((int(user1_id), int(user2_id)))
+    return f"conversation:{low}:{high}:recent"
+
+def _conversation_count_key(key: str) -> str:
+    # Number of messages in the conversation the list above was built from
+    return f"{key}:count"
+
+def _serialize_message(message: models.Message) -> dict:
+    return schemas.Message.model_validate(message).model_dump(mode="json")
+
+async def cache_new_message(message: models.Message) -> None:
+    key = _conversation_cache_key(message.sender_id, message.receiver_id)
+    try:
+        await push_capped_list(
+            key, _serialize_message(message), settings.MESSAGE_CACHE_SIZE, settings.MESSAGE_CACHE_TTL_SECONDS,
+            count_key=_conversation_count_key(key)
+        )
+    except RedisError as e:
+        logger.warning("Failed to cache message %s: %s", message.id, e)
+
+async def _refill_conversation_cache(db: Session, key: str, user1_id: int, user2_id: int) -> tuple[List[dict], int]:
+    """Load the newest messages and the message count, and cache them unless db is a replica.
+
+    Rows and count come from one statement, so they describe the same
+    snapshot. A lagging replica's snapshot is served but never cached: the
+    list is shared with every reader, including those on the primary.
+    """
+    rows = db.query(models.Message, func.count().over().label("total")).filter(
+        ((models.Message.sender_id == user1_id) & (models.Message.receiver_id == user2_id)) |
+        ((models.Message.sender_id == user2_id) & (models.Message.receiver_id == user1_id))
+    ).order_by(models.Message.id.desc()).limit(settings.MESSAGE_CACHE_SIZE).all()
+    total = rows[0].total if rows else 0
+    cached = [_serialize_message(row.Message) for row in reversed(rows)]
+    if is_replica_session(db):
+        return cached, total
+    try:
+        await replace_list(
+            key, cached, settings.MESSAGE_CACHE_TTL_SECONDS,
+            count_key=_conversation_count_key(key), count=total
+        )
+    except RedisError as e:
+        logger.warning("Failed to fill message cache %s: %s", key, e)
+    return cached, total
+
+async def get_messages_between_users_cached(
+    db: Session,
+    user1_id: int,
+    user2_id: int,
+    skip: int = 0,
+    limit: int = 100,
+    watermark: Optional[tuple] = None
+) -> List[Union[dict, models.Message]]:
+    """Like get_messages_between_users, served from the hot-message cache when it covers the window.
+
+    The list is only trusted when the count stored with it equals the
+    conversation's message count and it ends with the newest message. Every
+    write-through bumps that count, so a write that missed the list (lost, or
+    overwritten by a refill from an older snapshot) makes the next read refill
+    instead of serving history with a gap.
+    """
+    total, last_id = watermark or get_conversation_watermark(db, user1_id, user2_id)
+    if not total or skip >= total:
+        return []
+
+    key = _conversation_cache_key(user1_id, user2_id)
+    try:
+        cached, cached_total = await get_counted_list(key, _conversation_count_key(key))
+    except RedisError as e:
+        logger.warning("Failed to read message cache %s: %s", key, e)
+        cached, cached_total = None, None
+    expected_size = min(total, settings.MESSAGE_CACHE_SIZE)
+    if not cached or cached_total != total or cached[-1]["id"] != last_id or len(cached) != expected_size:
+        cached, refill_total = await _refill_conversation_cache(db, key, user1_id, user2_id)
+        if refill_total != total:
+            # Messages arrived between the two queries; positions in the
+            # refilled list don't line up with the watermark
+            return get_messages_between_users(db, user1_id, user2_id, skip=skip, limit=limit)
+
+    # The cache holds positions [total - len(cached), total) of the history
+    first = total - len(cached)
+    if skip >= first:
+        return cached[skip - first:skip - first + limit]
+    return get_messages_between_users(db, user1_id, user2_id, skip=skip, limit=limit)
+
+# Watermarks for conditional requests: a few aggregates over indexed columns
+# that change whenever the corresponding response body would change
+def _page_watermark(db: Session, model, skip: int, limit: int) -> tuple:
+    page = db.query(
+        model.id.label("id"),
+        func.coalesce(model.updated_at, model.created_at).label("changed_at")
+    ).order_by(model.id).offset(skip).limit(limit).subquery()
+    return tuple(db.query(func.count(page.c.id), func.sum(page.c.id), func.max(page.c.changed_at)).one())
+
+def get_users_watermark(db: Session, skip: int = 0, limit: int = 100) -> tuple:
+    return _page_watermark(db, models.User, skip, limit)
+
+def get_items_watermark(db: Session, skip: int = 0, limit: int = 100) -> tuple:
+    return _page_watermark(db, models.Item, skip, limit)
+
+def get_item_watermark(db: Session, item_id: int) -> Optional[tuple]:
+    row = db.query(models.Item.id, models.Item.created_at, models.Item.updated_at).filter(models.Item.id == item_id).first()
+    return tuple(row) if row else None
+
+def get_conversation_watermark(db: Session, user1_id: int, user2_id: int) -> tuple:
+    """Message count and newest message ID between two users (messages are append-only)."""
+    return tuple(db.query(func.count(models.Message.id), func.max(models.Message.id)).filter(
+        ((models.Message.sender_id == user1_id) & (models.Message.receiver_id == user2_id)) |
+        ((models.Message.sender_id == user2_id) & (models.Message.receiver_id == user1_id))
+    ).one())
 
 # Original Item operations
-def get_item(db: Session, item_id: int) -> Optional[models.Item]:
+def _item_cache_value(item: models.Item) -> dict:
+    return {
+        "id": item.id,
+        "name": item.name,
+        "description": item.description,
+        "created_at": item.created_at.isoformat(),
+        "updated_at": item.updated_at.isoformat() if item.updated_at is not None else None
+    }
+
+def _load_item(db: Session, item_id: int) -> Optional[models.Item]:
+    return db.query(models.Item).filter(models.Item.id == item_id).first()
+
+async def get_item(db: Session, item_id: int) -> Optional[models.Item]:
     # Try to get from cache first
     cache_key = f"item:{item_id}"
-    cached_item = get_cache(cache_key)
+    cached_item = await get_cache(cache_key)
     if cached_item:
         return models.Item(**cached_item)
     
-    # If not in cache, get from database
-    item = db.query(models.Item).filter(models.Item.id == item_id).first()
-    if item and item.created_at is not None:
+    # If not in cache, get from database; the session is blocking, so off the event loop
+    item = await asyncio.to_thread(_load_item, db, item_id)
+    # A replica may be behind, and the cache is shared with readers on the primary
+    if item and item.created_at is not None and not is_replica_session(db):
         # Cache the item
-        set_cache(cache_key, {
-            "id": item.id,
-            "name": item.name,
-            "description": item.description,
-            "created_at": item.created_at.isoformat(),
-            "updated_at": item.updated_at.isoformat() if item.updated_at is not None else None
-        })
+        await set_cache(cache_key, _item_cache_value(item))
     return item
 
 def get_items(db: Session, skip: int = 0, limit: int = 100) -> List[models.Item]:
-    return db.query(models.Item).offset(skip).limit(limit).all()
+    return db.query(models.Item).order_by(models.Item.id).offset(skip).limit(limit).all()
 
 def create_item(db: Session, item: schemas.ItemCreate) -> models.Item:
     db_item = models.Item(**item.model_dump())
@@ -106,8 +554,9 @@ def create_item(db: Session, item: schemas.ItemCreate) -> models.Item:
     db.refresh(db_item)
     return db_item
 
-def update_item(db: Session, item_id: int, item: schemas.ItemUpdate) -> Optional[models.Item]:
-    db_item = get_item(db, item_id)
+def _update_item_row(db: Session, item_id: int, item: schemas.ItemUpdate) -> Optional[models.Item]:
+    # Load from the database: a cached copy is not attached to the session
+    db_item = _load_item(db, item_id)
     if not db_item:
         return None
     
@@ -117,31 +566,33 @@ def update_item(db: Session, item_id: int, item: schemas.ItemUpdate) -> Optional
     
     db.commit()
     db.refresh(db_item)
+    return db_item
+
+async def update_item(db: Session, item_id: int, item: schemas.ItemUpdate) -> Optional[models.Item]:
+    db_item = await asyncio.to_thread(_update_item_row, db, item_id, item)
+    if not db_item:
+        return None
     
-    # Update cache
-    cache_key = f"item:{item_id}"
-    delete_cache(cache_key)
-    set_cache(cache_key, {
-        "id": db_item.id,
-        "name": db_item.name,
-        "description": db_item.description,
-        "created_at": db_item.created_at.isoformat(),
-        "updated_at": db_item.updated_at.isoformat() if db_item.updated_at is not None else None
-    })
+    # Update cache; SETEX overwrites, so this is a single round trip
+    await set_cache(f"item:{item_id}", _item_cache_value(db_item))
     
     return db_item
 
-def delete_item(db: Session, item_id: int) -> bool:
-    db_item = get_item(db, item_id)
+def _delete_item_row(db: Session, item_id: int) -> bool:
+    db_item = _load_item(db, item_id)
     if not db_item:
         return False
     
     db.delete(db_item)
     db.commit()
+    return True
+
+async def delete_item(db: Session, item_id: int) -> bool:
+    if not await asyncio.to_thread(_delete_item_row, db, item_id):
+        return False
     
     # Delete from cache
-    cache_key = f"item:{item_id}"
-    delete_cache(cache_key)
+    await delete_cache(f"item:{item_id}")
     
     return True
 
@@ -191,12 +642,18 @@ async def create_message_with_media(
     db.add(db_message)
     db.commit()
     db.refresh(db_message)
+    await cache_new_message(db_message)
     return db_message
 
 def get_message_media(db: Session, message_id: int) -> Optional[tuple[bytes, str]]:
-    """Get media file data and MIME type for a message."""
-    message = db.query(models.Message).filter(models.Message.id == message_id).first()
-    media_data = getattr(message, 'media_data', None) if message else None
+    """Get media file data and MIME type for a message.
+
+    This is the only place media blobs are read; message listings never load them.
+    """
+    message = db.query(models.Message.media_data, models.Message.message_type).filter(
+        models.Message.id == message_id
+    ).first()
+    media_data = message.media_data if message else None
     if not message or media_data is None or not isinstance(media_data, (bytes, bytearray)):
         return None
     # Determine media type from the message type
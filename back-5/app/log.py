@@ -0,0 +1,220 @@
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+from typing import Dict, Optional, Tuple
+import atexit
+import enum
+import json
+import logging
+import queue
+import random
+import sys
+import threading
+import time
+import uuid
+from .config import settings
+
+# Set per HTTP request / WebSocket connection by RequestContextMiddleware and
+# attached to every record logged while handling it
+request_id_var: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+connection_id_var: ContextVar[Optional[str]] = ContextVar("connection_id", default=None)
+
+# Arguments of these types can't change after the call, so formatting them
+# can safely wait for the listener thread
+_IMMUTABLE_ARG_TYPES = (str, int, float, bool, type(None), bytes, enum.Enum, uuid.UUID, datetime)
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+MAX_RATE_LIMIT_KEYS = 10000
+
+_listener: Optional[QueueListener] = None
+
+class LazyQueueHandler(QueueHandler):
+    """Hands records to a QueueListener without formatting them first.
+
+    The stdlib QueueHandler formats every record on the calling thread (so it
+    can be pickled to another process). Here the listener is a thread in the
+    same process, so message interpolation, JSON encoding and tracebacks all
+    happen there, and the caller only pays for the LogRecord and a queue put.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record.request_id = request_id_var.get()
+        record.connection_id = connection_id_var.get()
+        args = record.args
+        if args and not all(isinstance(arg, _IMMUTABLE_ARG_TYPES) for arg in (args.values() if isinstance(args, dict) else args)):
+            # Snapshot mutable arguments now, as they are at the call
+            record.msg = record.getMessage()
+            record.args = None
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            # Never block the event loop on a backed up log writer
+            self.dropped += 1
+
+class JSONFormatter(logging.Formatter):
+    """One JSON object per line, including request/connection IDs and extra= fields."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "timestamp": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and value is not None:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry["stack_info"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+class SamplingFilter(logging.Filter):
+    """Keep a random fraction of a logger's records below WARNING."""
+
+    def __init__(self, rate: float):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        return record.levelno >= logging.WARNING or random.random() < self.rate
+
+class RateLimitFilter(logging.Filter):
+    """Token bucket per message template, allowing `per_second` records with bursts of `burst`.
+
+    The next record let through for a template carries the number dropped
+    before it as `suppressed`.
+    """
+
+    def __init__(self, per_second: float, burst: Optional[float] = None):
+        super().__init__()
+        self.per_second = per_second
+        self.burst = burst if burst is not None else max(per_second, 1.0)
+        self._buckets: Dict[Tuple[str, int], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        key = (str(record.msg), record.levelno)
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                if len(self._buckets) >= MAX_RATE_LIMIT_KEYS:
+                    # Messages with values baked in (f-strings) make a new
+                    # template each time; don't let them grow this forever
+                    self._buckets.clear()
+                # tokens, last refill, suppressed count
+                bucket = self._buckets[key] = [self.burst, now, 0]
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.per_second)
+            bucket[1] = now
+            if bucket[0] < 1:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1
+            suppressed, bucket[2] = bucket[2], 0
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+def setup_logging(force: bool = False) -> None:
+    """Route all logging through a queue to a background writer thread.
+
+    Like logging.basicConfig, does nothing if the root logger already has
+    handlers, unless force is set.
+    """
+    global _listener
+    root = logging.getLogger()
+    if root.handlers and not force:
+        return
+    shutdown()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    output = logging.StreamHandler(sys.stdout)
+    if settings.LOG_FORMAT == "json":
+        output.setFormatter(JSONFormatter())
+    else:
+        output.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_queue: queue.Queue = queue.Queue(maxsize=settings.LOG_QUEUE_SIZE)
+    _listener = QueueListener(log_queue, output, respect_handler_level=True)
+    _listener.start()
+
+    root.addHandler(LazyQueueHandler(log_queue))
+    root.setLevel(settings.LOG_LEVEL)
+    # Uvicorn writes its own logs (including one access line per request)
+    # synchronously; send them through the queue too
+    for name in ("uvicorn", "uvicorn.error", "uvicorn.access"):
+        uvicorn_logger = logging.getLogger(name)
+        uvicorn_logger.handlers.clear()
+        uvicorn_logger.propagate = True
+
+    # Filters on the logger itself run on the calling thread, before the
+    # record is queued, so dropped records cost next to nothing
+    for name in set(settings.LOG_SAMPLE_RATES) | set(settings.LOG_RATE_LIMITS):
+        configured = logging.getLogger(name)
+        for existing in list(configured.filters):
+            if isinstance(existing, (SamplingFilter, RateLimitFilter)):
+                configured.removeFilter(existing)
+        if name in settings.LOG_SAMPLE_RATES:
+            configured.addFilter(SamplingFilter(settings.LOG_SAMPLE_RATES[name]))
+        if name in settings.LOG_RATE_LIMITS:
+            configured.addFilter(RateLimitFilter(settings.LOG_RATE_LIMITS[name]))
+
+def shutdown() -> None:
+    """Write out the records still queued and stop the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+atexit.register(shutdown)
+
+class RequestContextMiddleware:
+    """ASGI middleware giving each HTTP request and WebSocket connection an ID for its logs.
+
+    HTTP requests reuse an incoming X-Request-ID header, and the ID is sent
+    back in the response.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "websocket":
+            token = connection_id_var.set(uuid.uuid4().hex)
+            try:
+                await self.app(scope, receive, send)
+            finally:
+                connection_id_var.reset(token)
+            return
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = None
+        for name, value in scope["headers"]:
+            if name == b"x-request-id":
+                request_id = value.decode("latin-1")[:64]
+                break
+        request_id = request_id or uuid.uuid4().hex
+
+        async def send_with_request_id(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-request-id", request_id.encode("latin-1"))]
+            await send(message)
+
+        token = request_id_var.set(request_id)
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            request_id_var.reset(token)
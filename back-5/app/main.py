@@ -1,11 +1,13 @@
-from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, status, UploadFile, File, Form
+from fastapi import FastAPI, Depends, HTTPException, WebSocket, WebSocketDisconnect, status, UploadFile, File, Form, Header, Query, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from sqlalchemy.orm import Session
 from typing import List, Dict, Any, Optional
-from datetime import timedelta, datetime
+from datetime import timedelta, datetime, timezone
+from redis.exceptions import RedisError
+import asyncio
 import json
 import os
 import base64
@@ -13,17 +15,18 @@ from jose import jwt
 import logging
 from pathlib import Path
 import uuid
+import zlib
 
-from . import crud, models, schemas, auth
-from .database import engine, get_db
+from . import crud, models, schemas, auth, profiling, uploads, log
+from .cache import get_cache, set_cache
+from .database import engine, get_db, get_read_db, open_read_session, replica_router, request_subject, websocket_subject, pin_to_primary
 from .websocket import manager
+from .timers import MessageScheduler
+from .conditional import make_etag, not_modified_response
 from .config import settings
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+# Configure logging: records are written by a background thread, off the event loop
+log.setup_logging()
 logger = logging.getLogger(__name__)
 
 # Create database tables
@@ -41,14 +44,31 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(profiling.ProfilingMiddleware)
+app.add_middleware(log.RequestContextMiddleware)
+
+scheduler = MessageScheduler(manager)
+
+@app.on_event("startup")
+async def startup_event():
+    if settings.SCHEDULER_ENABLED:
+        await scheduler.start()
+
+@app.middleware("http")
+async def pin_writers_to_primary(request: Request, call_next):
+    """Route a user's reads to the primary for a short while after they write."""
+    response = await call_next(request)
+    if replica_router.engines and request.method not in ("GET", "HEAD", "OPTIONS") and response.status_code < 400:
+        subject = request_subject(request)
+        if subject:
+            pin_to_primary(subject)
+    return response
 
 @app.on_event("shutdown")
 async def shutdown_event():
     logger.info("Shutting down application...")
-    # Close all WebSocket connections
-    for user_id in list(manager.active_connections.keys()):
-        await manager.disconnect(user_id)
-    logger.info("All WebSocket connections closed")
+    await scheduler.stop()
+    # WebSocket connections are drained by app.server before uvicorn closes them
 
 # User management endpoints
 @app.post("/users/", response_model=schemas.User)
@@ -60,15 +80,44 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
 
 @app.get("/users/", response_model=List[schemas.User])
 def read_users(
+    request: Request,
+    response: Response,
     skip: int = 0,
     limit: int = 100,
-    db: Session = Depends(get_db),
+    db: Session = Depends(get_read_db),
     current_user: models.User = Depends(auth.get_current_active_user)
 ):
     """Get list of users."""
+    etag = make_etag("users", skip, limit, *crud.get_users_watermark(db, skip=skip, limit=limit))
+    not_modified = not_modified_response(request, response, etag)
+    if not_modified:
+        return not_modified
     users = crud.get_users(db, skip=skip, limit=limit)
     return users
 
+@app.get("/users/search", response_model=List[schemas.UserSummary])
+async def search_users(
+    q: str = Query(..., min_length=1, max_length=64),
+    limit: int = Query(10, ge=1, le=50),
+    db: Session = Depends(get_read_db),
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    """Autocomplete users by username or email prefix."""
+    cache_key = f"user-search:{limit}:{q.strip().lower()}"
+    try:
+        cached = await get_cache(cache_key)
+    except RedisError as e:
+        logger.warning("Failed to read user search cache: %s", e)
+        cached = None
+    if cached is not None:
+        return cached
+    users = [{"id": row.id, "username": row.username} for row in crud.search_users(db, q, limit=limit)]
+    try:
+        await set_cache(cache_key, users, expire=settings.USER_SEARCH_CACHE_SECONDS)
+    except RedisError as e:
+        logger.warning("Failed to write user search cache: %s", e)
+    return users
+
 @app.post("/token", response_model=schemas.Token)
 async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
     user = crud.authenticate_user(db, form_data.username, form_data.password)
@@ -85,68 +134,83 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
     return {"access_token": access_token, "token_type": "bearer"}
 
 @app.get("/users/me", response_model=schemas.User)
-def read_users_me(current_user: models.User = Depends(auth.get_current_active_user)):
+def read_users_me(
+    request: Request,
+    response: Response,
+    current_user: models.User = Depends(auth.get_current_active_user)
+):
+    etag = make_etag("user", current_user.id, current_user.created_at, current_user.updated_at)
+    not_modified = not_modified_response(request, response, etag)
+    if not_modified:
+        return not_modified
     return current_user
 
 # WebSocket endpoints
 @app.websocket("/ws/{user_id}")
 async def websocket_endpoint(websocket: WebSocket, user_id: int, db: Session = Depends(get_db)):
     try:
-        await manager.connect(websocket, user_id)
-        logger.info(f"User {user_id} connected to WebSocket")
+        if not await manager.connect(websocket, user_id):
+            return
+        logger.info("User %s connected to WebSocket", user_id)
+        subject = websocket_subject(websocket)
         
         try:
             while True:
                 data = await websocket.receive_text()
-                try:
-                    message_data = json.loads(data)
-                    # Handle WebRTC signaling
-                    if message_data.get('type') == 'webrtc-signal':
-                        await manager.handle_webrtc_signal(message_data, int(user_id))
-                        continue
-                    # Validate required fields
-                    if not all(k in message_data for k in ["target_id", "content"]):
-                        await websocket.send_json({"type": "error", "message": "Missing required fields"})
-                        continue
-
-                    # Create message using crud function
-                    message = crud.create_message(
-                        db=db,
-                        message=schemas.MessageCreate(
-                            receiver_id=int(message_data["target_id"]),
-                            content=message_data["content"],
-                            message_type=models.MessageType.TEXT
-                        ),
-                        sender_id=int(user_id)
-                    )
-
-                    if not message:
-                        await websocket.send_json({"type": "error", "message": "Failed to save message"})
-                        continue
-
-                    # Prepare message data for both sender and receiver
-                    message_data = {
-                        "type": "message",
-                        "id": message.id,
-                        "from_user": user_id,
-                        "to_user": int(message_data["target_id"]),
-                        "content": message_data["content"],
-                        "message_type": "TEXT",
-                        "timestamp": message.created_at.isoformat()
-                    }
-
-                    # Send to both sender and receiver
-                    await manager.send_personal_message(message_data, user_id)  # Send to sender
-                    await manager.send_personal_message(message_data, int(message_data["target_id"]))  # Send to receiver
-
-                except json.JSONDecodeError:
-                    logger.exception("Invalid JSON received in WebSocket")
-                    await websocket.send_json({"type": "error", "message": "Invalid JSON format"})
-                except Exception as e:
-                    logger.exception("Error processing WebSocket message")
-                    await websocket.send_json({"type": "error", "message": str(e)})
+                with profiling.capture("websocket", "frame /ws/{user_id}"):
+                    async with manager.in_flight():
+                        try:
+                            message_data = json.loads(data)
+                            # Handle WebRTC signaling
+                            if message_data.get('type') == 'webrtc-signal':
+                                await manager.handle_webrtc_signal(message_data, int(user_id))
+                                continue
+                            # Validate required fields
+                            if not all(k in message_data for k in ["target_id", "content"]):
+                                await websocket.send_json({"type": "error", "message": "Missing required fields"})
+                                continue
+
+                            # Create message using crud function
+                            message = await crud.create_message(
+                                db=db,
+                                message=schemas.MessageCreate(
+                                    receiver_id=int(message_data["target_id"]),
+                                    content=message_data["content"],
+                                    message_type=models.MessageType.TEXT
+                                ),
+                                sender_id=int(user_id)
+                            )
+
+                            if not message:
+                                await websocket.send_json({"type": "error", "message": "Failed to save message"})
+                                continue
+                            # Read-your-writes, as pin_writers_to_primary does for HTTP
+                            if replica_router.engines and subject:
+                                pin_to_primary(subject)
+
+                            # Prepare message data for both sender and receiver
+                            message_data = {
+                                "type": "message",
+                                "id": message.id,
+                                "from_user": user_id,
+                                "to_user": int(message_data["target_id"]),
+                                "content": message_data["content"],
+                                "message_type": "TEXT",
+                                "timestamp": message.created_at.isoformat()
+                            }
+
+                            # Send to both sender and receiver
+                            await manager.send_personal_message(message_data, user_id)  # Send to sender
+                            await manager.send_personal_message(message_data, int(message_data["target_id"]))  # Send to receiver
+
+                        except json.JSONDecodeError:
+                            logger.exception("Invalid JSON received in WebSocket")
+                            await websocket.send_json({"type": "error", "message": "Invalid JSON format"})
+                        except Exception as e:
+                            logger.exception("Error processing WebSocket message")
+                            await websocket.send_json({"type": "error", "message": str(e)})
         except WebSocketDisconnect:
-            logger.info(f"User {user_id} disconnected from WebSocket")
+            logger.info("User %s disconnected from WebSocket", user_id)
             await manager.disconnect(user_id)
     except Exception as e:
         logger.exception("WebSocket connection error")
@@ -155,28 +219,147 @@ async def websocket_endpoint(websocket: WebSocket, user_id: int, db: Session = D
 # Message endpoints
 @app.get("/messages/", response_model=List[schemas.Message])
 async def get_messages(
+    request: Request,
+    response: Response,
     receiver_id: Optional[int] = None,
+    skip: int = 0,
+    limit: int = 100,
     current_user: models.User = Depends(auth.get_current_user),
-    db: Session = Depends(get_db)
+    db: Session = Depends(get_read_db)
 ):
     """Get messages between current user and another user."""
     if receiver_id is None:
         raise HTTPException(status_code=400, detail="receiver_id is required")
-    
-    messages = crud.get_messages_between_users(
+
+    watermark = crud.get_conversation_watermark(db, int(str(current_user.id)), receiver_id)
+    etag = make_etag("messages", current_user.id, receiver_id, skip, limit, *watermark)
+    not_modified = not_modified_response(request, response, etag)
+    if not_modified:
+        return not_modified
+
+    messages = await crud.get_messages_between_users_cached(
         db=db, 
         user1_id=int(str(current_user.id)), 
-        user2_id=receiver_id
+        user2_id=receiver_id,
+        skip=skip,
+        limit=limit,
+        watermark=watermark
     )
     return messages
 
+EXPORT_CHUNK_SIZE = 64 * 1024
+
+def _export_chunks(user_id: int, receiver_id: Optional[int], after_id: int, subject: Optional[str], compress: bool):
+    """Encode messages as NDJSON in ~64KB chunks, optionally as a gzip stream.
+
+    Runs in a worker thread with its own session, which lives as long as the stream.
+    """
+    # Sync-flushed after every chunk, so a client can decompress whatever arrived
+    # before a broken connection and resume from the last complete line
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    db = open_read_session(subject)
+    try:
+        lines = []
+        size = 0
+        for row in crud.iter_user_messages(db, user_id, other_user_id=receiver_id, after_id=after_id):
+            line = json.dumps({
+                "id": row.id,
+                "sender_id": row.sender_id,
+                "receiver_id": row.receiver_id,
+                "message_type": row.message_type.value if row.message_type else None,
+                "content": row.content,
+                "created_at": row.created_at.isoformat() if row.created_at else None,
+                "media": {"url": f"/messages/{row.id}/media"} if row.has_media else None,
+            }) + "\n"
+            lines.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_SIZE:
+                chunk = "".join(lines).encode()
+                lines, size = [], 0
+                yield compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH) if compressor else chunk
+        chunk = "".join(lines).encode()
+        if compressor:
+            yield compressor.compress(chunk) + compressor.flush()
+        elif chunk:
+            yield chunk
+    finally:
+        db.close()
+
+@app.get("/messages/export")
+async def export_messages(
+    request: Request,
+    receiver_id: Optional[int] = None,
+    after_id: int = 0,
+    gzip: bool = False,
+    current_user: models.User = Depends(auth.get_current_user)
+):
+    """Stream the current user's message history as NDJSON, oldest first.
+
+    Media is referenced by URL rather than inlined. To resume an interrupted
+    export, pass the ID of the last message received as after_id.
+    """
+    user_id = int(str(current_user.id))
+    filename = f"messages-{user_id}.ndjson" + (".gz" if gzip else "")
+    return StreamingResponse(
+        _export_chunks(user_id, receiver_id, after_id, request_subject(request), gzip),
+        media_type="application/gzip" if gzip else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+@app.post("/messages/scheduled", response_model=schemas.ScheduledMessage)
+async def create_scheduled_message(
+    message: schemas.ScheduledMessageCreate,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Schedule a text message to be sent at due_at."""
+    db_scheduled = crud.create_scheduled_message(db=db, message=message, sender_id=int(str(current_user.id)))
+    scheduler.schedule(db_scheduled.id, db_scheduled.due_at)
+    return db_scheduled
+
+@app.get("/messages/scheduled", response_model=List[schemas.ScheduledMessage])
+async def get_scheduled_messages(
+    skip: int = 0,
+    limit: int = 100,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Get the current user's pending scheduled messages, soonest first."""
+    return crud.get_pending_scheduled_messages(db, sender_id=int(str(current_user.id)), skip=skip, limit=limit)
+
+@app.delete("/messages/scheduled/{scheduled_id}")
+async def cancel_scheduled_message(
+    scheduled_id: int,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    if not crud.cancel_scheduled_message(db, scheduled_id=scheduled_id, sender_id=int(str(current_user.id))):
+        raise HTTPException(status_code=404, detail="Scheduled message not found")
+    scheduler.cancel(scheduled_id)
+    return {"message": "Scheduled message cancelled"}
+
+@app.get("/messages/{message_id}/media")
+async def get_message_media(
+    message_id: int,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_read_db)
+):
+    message = crud.get_message(db, message_id)
+    if message is None or current_user.id not in (message.sender_id, message.receiver_id):
+        raise HTTPException(status_code=404, detail="Media not found")
+    media = crud.get_message_media(db, message_id)
+    if media is None:
+        raise HTTPException(status_code=404, detail="Media not found")
+    media_data, media_type = media
+    return Response(content=media_data, media_type=media_type)
+
 @app.post("/messages/", response_model=schemas.Message)
 async def create_message(
     message: schemas.MessageCreate,
     current_user: models.User = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    return crud.create_message(db=db, message=message, sender_id=int(str(current_user.id)))
+    return await crud.create_message(db=db, message=message, sender_id=int(str(current_user.id)))
 
 @app.post("/messages/media/")
 async def create_message_with_media(
@@ -185,9 +368,7 @@ async def create_message_with_media(
     current_user: models.User = Depends(auth.get_current_user),
     db: Session = Depends(get_db)
 ):
-    import logging
-    logger = logging.getLogger("uvicorn.error")
-    logger.info(f"[MEDIA UPLOAD] receiver_id={receiver_id}, filename={file.filename}, content_type={file.content_type}")
+    logger.info("[MEDIA UPLOAD] receiver_id=%s, filename=%s, content_type=%s", receiver_id, file.filename, file.content_type)
     if receiver_id is None:
         logger.error("[MEDIA UPLOAD] receiver_id is None!")
         raise HTTPException(status_code=400, detail="receiver_id is required")
@@ -203,7 +384,7 @@ async def create_message_with_media(
             content = await file.read()
             f.write(content)
     except Exception as e:
-        logger.error(f"[MEDIA UPLOAD] Failed to save file: {e}")
+        logger.error("[MEDIA UPLOAD] Failed to save file: %s", e)
         raise HTTPException(status_code=500, detail="Failed to save file")
     # Detect image/audio type
     image_extensions = ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']
@@ -213,14 +394,14 @@ async def create_message_with_media(
         msg_type = models.MessageType.VOICE
     else:
         msg_type = models.MessageType.TEXT
-    logger.info(f"[MEDIA UPLOAD] Final msg_type: {msg_type}, content: {unique_name}")
+    logger.info("[MEDIA UPLOAD] Final msg_type: %s, content: %s", msg_type, unique_name)
     # Create message
     message = schemas.MessageCreate(
         receiver_id=receiver_id,
         content=unique_name,
         message_type=msg_type,  # Pass the enum, not the string
     )
-    logger.info(f"[MEDIA UPLOAD] Created message: {message}")
+    logger.debug("[MEDIA UPLOAD] Created message: %s", message)
     file.file.seek(0)  # Reset file pointer
     db_message = await crud.create_message_with_media(db=db, message=message, sender_id=int(str(current_user.id)), media_file=file)
     return {
@@ -242,6 +423,134 @@ async def get_media(filename: str):
         raise HTTPException(status_code=404, detail="File not found")
     return FileResponse(file_path)
 
+# Resumable uploads: create a session, PUT the file in chunks at the offset
+# the server has so far, then complete it to send the message
+def _get_upload_or_404(db: Session, upload_id: str, user_id: int) -> models.UploadSession:
+    upload = crud.get_upload_session(db, upload_id, user_id)
+    if upload is None:
+        raise HTTPException(status_code=404, detail="Upload not found")
+    return upload
+
+@app.post("/uploads/", response_model=schemas.UploadSession, status_code=status.HTTP_201_CREATED)
+async def create_upload(
+    upload: schemas.UploadCreate,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    if upload.size > settings.UPLOAD_MAX_SIZE_BYTES:
+        raise HTTPException(status_code=413, detail=f"Uploads are limited to {settings.UPLOAD_MAX_SIZE_BYTES} bytes")
+    user_id = int(str(current_user.id))
+    active_since = datetime.now(timezone.utc) - timedelta(seconds=settings.UPLOAD_SESSION_TTL_SECONDS)
+    if crud.count_active_uploads(db, user_id, since=active_since) >= settings.UPLOAD_MAX_CONCURRENT_PER_USER:
+        raise HTTPException(status_code=429, detail="Too many uploads in progress")
+    upload_id = uuid.uuid4().hex
+    uploads.create_temp_file(upload_id)
+    try:
+        return crud.create_upload_session(
+            db, upload, upload_id=upload_id, user_id=user_id,
+            message_type=uploads.message_type_for(upload.filename, upload.content_type)
+        )
+    except Exception:
+        uploads.remove_temp_file(upload_id)
+        raise
+
+@app.get("/uploads/{upload_id}", response_model=schemas.UploadSession)
+async def get_upload(
+    upload_id: str,
+    response: Response,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Get an upload, including the offset to resume it from."""
+    upload = _get_upload_or_404(db, upload_id, int(str(current_user.id)))
+    response.headers["Upload-Offset"] = str(upload.offset)
+    return upload
+
+@app.put("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def upload_chunk(
+    upload_id: str,
+    request: Request,
+    upload_offset: int = Header(..., ge=0),
+    upload_checksum: Optional[str] = Header(None),
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Append the request body to an upload at Upload-Offset.
+
+    The offset must be the one the server has; an optional Upload-Checksum
+    header ("sha256 <base64 digest>") is checked before the chunk is accepted.
+    """
+    upload = _get_upload_or_404(db, upload_id, int(str(current_user.id)))
+    if upload.status != models.UploadStatus.ACTIVE:
+        raise HTTPException(status_code=409, detail="Upload already completed")
+    if upload_offset != upload.offset:
+        raise HTTPException(status_code=409, detail="Offset mismatch", headers={"Upload-Offset": str(upload.offset)})
+    max_bytes = min(settings.UPLOAD_MAX_CHUNK_BYTES, upload.size - upload.offset)
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > max_bytes:
+        raise HTTPException(status_code=413, detail="Chunk too large")
+    checksum = uploads.parse_checksum(upload_checksum)
+    # Only one request writes the file at a time, e.g. not a retry while the
+    # original is still streaming
+    writer = uuid.uuid4().hex
+    stale_before = datetime.now(timezone.utc) - timedelta(seconds=2 * settings.UPLOAD_CHUNK_TIMEOUT_SECONDS)
+    if not crud.claim_upload_writer(db, upload_id, upload_offset, writer, stale_before):
+        raise HTTPException(status_code=409, detail="Another request is writing this upload", headers={"Upload-Offset": str(upload.offset)})
+    # Don't hold a pooled connection while the body streams in
+    db.close()
+    try:
+        try:
+            # Bounded, so the claim is never held long enough to go stale
+            written = await asyncio.wait_for(
+                uploads.write_chunk(upload_id, upload_offset, max_bytes, request.stream(), checksum),
+                timeout=settings.UPLOAD_CHUNK_TIMEOUT_SECONDS
+            )
+        except asyncio.TimeoutError:
+            raise HTTPException(status_code=status.HTTP_408_REQUEST_TIMEOUT, detail="Chunk took too long")
+        new_offset = upload_offset + written
+        if not crud.advance_upload_offset(db, upload_id, upload_offset, new_offset, writer):
+            raise HTTPException(status_code=409, detail="Offset mismatch")
+    except BaseException:
+        # Drop the partial chunk, unless the claim was lost to another writer
+        if crud.holds_upload_writer(db, upload_id, writer):
+            await uploads.truncate_temp_file(upload_id, upload_offset)
+        raise
+    finally:
+        crud.release_upload_writer(db, upload_id, writer)
+    return Response(status_code=status.HTTP_204_NO_CONTENT, headers={"Upload-Offset": str(new_offset)})
+
+@app.post("/uploads/{upload_id}/complete", response_model=schemas.Message)
+async def complete_upload(
+    upload_id: str,
+    current_user: models.User = Depends(auth.get_current_user),
+    db: Session = Depends(get_db)
+):
+    """Finish a fully received upload and send it as a message; safe to retry."""
+    upload = _get_upload_or_404(db, upload_id, int(str(current_user.id)))
+    if upload.status == models.UploadStatus.ACTIVE:
+        if upload.offset != upload.size:
+            raise HTTPException(status_code=409, detail="Upload incomplete", headers={"Upload-Offset": str(upload.offset)})
+        size, filename = upload.size, upload.filename
+        db.close()
+        try:
+            content = await asyncio.to_thread(uploads.finalize, upload_id, size, filename)
+        except FileNotFoundError:
+            # Completed concurrently, or expired
+            content = None
+        except uploads.IncompleteUploadError as e:
+            logger.error("Not completing upload: %s", e)
+            raise HTTPException(status_code=409, detail="Upload data is incomplete, start a new upload")
+        db_message = crud.complete_upload_session(db, upload_id, content) if content else None
+        if db_message is not None:
+            await crud.cache_new_message(db_message)
+            return db_message
+        if content:
+            uploads.remove_media_file(content)
+        upload = _get_upload_or_404(db, upload_id, int(str(current_user.id)))
+    if upload.message_id is None:
+        raise HTTPException(status_code=410, detail="Upload expired")
+    return crud.get_message(db, upload.message_id)
+
 # Original CRUD endpoints
 @app.get("/")
 async def root():
@@ -261,31 +570,63 @@ def create_item(item: schemas.ItemCreate, db: Session = Depends(get_db)):
     return crud.create_item(db=db, item=item)
 
 @app.get("/items/", response_model=List[schemas.Item])
-def read_items(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+def read_items(request: Request, response: Response, skip: int = 0, limit: int = 100, db: Session = Depends(get_read_db)):
+    etag = make_etag("items", skip, limit, *crud.get_items_watermark(db, skip=skip, limit=limit))
+    not_modified = not_modified_response(request, response, etag, private=False)
+    if not_modified:
+        return not_modified
     items = crud.get_items(db, skip=skip, limit=limit)
     return items
 
 @app.get("/items/{item_id}", response_model=schemas.Item)
-def read_item(item_id: int, db: Session = Depends(get_db)):
-    db_item = crud.get_item(db, item_id=item_id)
+async def read_item(request: Request, response: Response, item_id: int, db: Session = Depends(get_read_db)):
+    watermark = await asyncio.to_thread(crud.get_item_watermark, db, item_id=item_id)
+    if watermark is None:
+        raise HTTPException(status_code=404, detail="Item not found")
+    not_modified = not_modified_response(request, response, make_etag("item", *watermark), private=False)
+    if not_modified:
+        return not_modified
+    db_item = await crud.get_item(db, item_id=item_id)
     if db_item is None:
         raise HTTPException(status_code=404, detail="Item not found")
     return db_item
 
 @app.put("/items/{item_id}", response_model=schemas.Item)
-def update_item(item_id: int, item: schemas.ItemUpdate, db: Session = Depends(get_db)):
-    db_item = crud.update_item(db, item_id=item_id, item=item)
+async def update_item(item_id: int, item: schemas.ItemUpdate, db: Session = Depends(get_db)):
+    db_item = await crud.update_item(db, item_id=item_id, item=item)
     if db_item is None:
         raise HTTPException(status_code=404, detail="Item not found")
     return db_item
 
 @app.delete("/items/{item_id}")
-def delete_item(item_id: int, db: Session = Depends(get_db)):
-    success = crud.delete_item(db, item_id=item_id)
+async def delete_item(item_id: int, db: Session = Depends(get_db)):
+    success = await crud.delete_item(db, item_id=item_id)
     if not success:
         raise HTTPException(status_code=404, detail="Item not found")
     return {"message": "Item deleted successfully"}
 
+# Admin endpoints
+@app.get("/admin/profiles")
+def list_profiles(current_user: models.User = Depends(auth.get_current_admin_user)):
+    """Summaries of captured request profiles, newest first."""
+    return profiling.list_profiles()
+
+@app.get("/admin/profiles/{profile_id}")
+def download_profile(
+    profile_id: str,
+    format: str = "json",
+    current_user: models.User = Depends(auth.get_current_admin_user)
+):
+    """Download a captured profile as JSON, or its stack samples in collapsed (flamegraph) format."""
+    record = profiling.get_profile(profile_id)
+    if record is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "collapsed":
+        headers = {"Content-Disposition": f'attachment; filename="profile-{profile_id}.folded"'}
+        return PlainTextResponse(profiling.to_collapsed(record), headers=headers)
+    headers = {"Content-Disposition": f'attachment; filename="profile-{profile_id}.json"'}
+    return JSONResponse(record, headers=headers)
+
 @app.get("/health")
 async def health_check():
     return {"status": "healthy"} 
\ No newline at end of file
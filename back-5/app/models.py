@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, LargeBinary, Enum
+from sqlalchemy import Column, Integer, BigInteger, String, DateTime, ForeignKey, Enum, Index
 from sqlalchemy.sql import func
-from sqlalchemy.orm import relationship
+from sqlalchemy.orm import relationship, deferred
 import enum
+from .compression import CompressedBinary, CompressedText
 from .database import Base
 
 class MessageType(enum.Enum):
@@ -10,6 +11,15 @@ class MessageType(enum.Enum):
     VIDEO = "video"
     IMAGE = "image"
 
+class ScheduledMessageStatus(enum.Enum):
+    PENDING = "pending"
+    DELIVERED = "delivered"
+    CANCELLED = "cancelled"
+
+class UploadStatus(enum.Enum):
+    ACTIVE = "active"
+    COMPLETED = "completed"
+
 class Item(Base):
     __tablename__ = "items"
 
@@ -33,17 +43,74 @@ class User(Base):
     sent_messages = relationship("Message", back_populates="sender", foreign_keys="Message.sender_id")
     received_messages = relationship("Message", back_populates="receiver", foreign_keys="Message.receiver_id")
 
+# Case-insensitive prefix search on username/email (crud.search_users). On
+# Postgres the "C" collation makes both the prefix range and the ordering an
+# index range scan; SQLite compares bytes already.
+Index("ix_users_username_prefix", func.lower(User.username).collate("C")).ddl_if(dialect="postgresql")
+Index("ix_users_email_prefix", func.lower(User.email).collate("C")).ddl_if(dialect="postgresql")
+Index("ix_users_username_lower", func.lower(User.username)).ddl_if(dialect="sqlite")
+Index("ix_users_email_lower", func.lower(User.email)).ddl_if(dialect="sqlite")
+
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # Serves conversation lookups in both directions, including the
+        # count/max(id) watermark used for conditional requests
+        Index("ix_messages_conversation", "sender_id", "receiver_id", "id"),
+        # Received messages of a user; sent ones use the index above
+        Index("ix_messages_receiver", "receiver_id", "id"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     sender_id = Column(Integer, ForeignKey("users.id"))
     receiver_id = Column(Integer, ForeignKey("users.id"))
     message_type = Column(Enum(MessageType))
-    content = Column(String, nullable=True)  # For text messages
-    media_data = Column(LargeBinary, nullable=True)  # For voice/video messages
+    # For text messages. Long texts are stored compressed (see app/compression.py)
+    content = Column(CompressedText, nullable=True)
+    # For voice/video messages. Can be megabytes per row, so it is never loaded
+    # with the message: reading it without an explicit undefer() or a column
+    # query (see crud.get_message_media) raises instead of silently fetching it.
+    # Compressed unless the format is compressed already.
+    media_data = deferred(Column(CompressedBinary, nullable=True), raiseload=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
 
     # Relationships
     sender = relationship("User", back_populates="sent_messages", foreign_keys=[sender_id])
-    receiver = relationship("User", back_populates="received_messages", foreign_keys=[receiver_id]) 
\ No newline at end of file
+    receiver = relationship("User", back_populates="received_messages", foreign_keys=[receiver_id])
+
+class ScheduledMessage(Base):
+    __tablename__ = "scheduled_messages"
+    __table_args__ = (
+        # The scheduler repeatedly asks for pending messages due before a time
+        Index("ix_scheduled_messages_status_due_at", "status", "due_at"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    sender_id = Column(Integer, ForeignKey("users.id"), index=True)
+    receiver_id = Column(Integer, ForeignKey("users.id"))
+    content = Column(String)
+    due_at = Column(DateTime(timezone=True), nullable=False)
+    status = Column(Enum(ScheduledMessageStatus), nullable=False, default=ScheduledMessageStatus.PENDING)
+    message_id = Column(Integer, ForeignKey("messages.id"), nullable=True)  # Set once delivered
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+# A resumable media upload; the bytes received so far are in a temp file
+# named after the session ID (see app/uploads.py)
+class UploadSession(Base):
+    __tablename__ = "upload_sessions"
+
+    id = Column(String(32), primary_key=True)  # Random, so sessions can't be guessed
+    user_id = Column(Integer, ForeignKey("users.id"), index=True)
+    receiver_id = Column(Integer, ForeignKey("users.id"))
+    filename = Column(String)
+    content_type = Column(String, nullable=True)
+    message_type = Column(Enum(MessageType))
+    size = Column(BigInteger, nullable=False)
+    offset = Column(BigInteger, nullable=False, default=0)
+    status = Column(Enum(UploadStatus), nullable=False, default=UploadStatus.ACTIVE)
+    message_id = Column(Integer, ForeignKey("messages.id"), nullable=True)  # Set once completed
+    # The request currently writing a chunk, so two never write the file at once
+    writer = Column(String(32), nullable=True)
+    writer_claimed_at = Column(DateTime(timezone=True), nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
@@ -0,0 +1,225 @@
+from collections import Counter, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional, Set
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import asyncio
+import logging
+import random
+import sys
+import threading
+import time
+import uuid
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+# Most recent captured profiles, newest first
+profiles: Deque[Dict[str, Any]] = deque(maxlen=settings.PROFILE_BUFFER_SIZE)
+
+_current_capture: ContextVar[Optional["Capture"]] = ContextVar("profiling_capture", default=None)
+
+# Stack sampling is the expensive part, so only one request is sampled at a time
+_sampler_slot = threading.Semaphore(1)
+
+MAX_RECORDED_QUERIES = 200
+MAX_STACK_DEPTH = 64
+
+def _collapse_stack(frame) -> str:
+    """Render a frame stack in collapsed (flamegraph) form, outermost call first."""
+    parts = []
+    while frame is not None and len(parts) < MAX_STACK_DEPTH:
+        code = frame.f_code
+        parts.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(parts))
+
+class SamplingProfiler(threading.Thread):
+    """Periodically samples the stacks of a set of threads from a background thread."""
+
+    def __init__(self, thread_ids: Set[int], interval: float):
+        super().__init__(name="sampling-profiler", daemon=True)
+        self.thread_ids = thread_ids
+        self.interval = interval
+        self._samples: Counter = Counter()
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                for thread_id in list(self.thread_ids):
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        self._samples[_collapse_stack(frame)] += 1
+
+    def stop(self) -> Dict[str, int]:
+        # Not joined, so the caller never waits for a sampling interval
+        self._stopped.set()
+        with self._lock:
+            return dict(self._samples)
+
+class Capture:
+    """SQL statements and (optionally) stack samples for one request or frame.
+
+    A capture started on the event loop thread samples that thread, which runs
+    every concurrent request's coroutines, not just this one's; its record is
+    marked whole_loop so the stacks are read accordingly.
+    """
+
+    def __init__(self, kind: str, name: str, sampled: bool):
+        self.kind = kind
+        self.name = name
+        self.sampled = sampled
+        self.started_at = datetime.utcnow()
+        self.started = time.perf_counter()
+        self.queries: List[tuple] = []
+        # Threads doing work for this capture: the one it started on, plus
+        # threadpool workers while they run a query for it
+        self.thread_id = threading.get_ident()
+        self.thread_ids: Set[int] = {self.thread_id}
+        self.whole_loop = _on_event_loop()
+        self.profiler: Optional[SamplingProfiler] = None
+
+    def start(self) -> None:
+        if self.sampled and _sampler_slot.acquire(blocking=False):
+            self.profiler = SamplingProfiler(self.thread_ids, settings.PROFILE_SAMPLE_INTERVAL_MS / 1000)
+            self.profiler.start()
+
+    def enter_thread(self) -> Optional[int]:
+        """Sample the calling thread until leave_thread; returns its ident if it was added."""
+        thread_id = threading.get_ident()
+        if thread_id == self.thread_id:
+            return None
+        self.thread_ids.add(thread_id)
+        return thread_id
+
+    def leave_thread(self, thread_id: Optional[int]) -> None:
+        # A worker goes back to the pool and may serve other requests next
+        if thread_id is not None:
+            self.thread_ids.discard(thread_id)
+
+    def record_query(self, statement: str, duration: float) -> None:
+        self.queries.append((statement, duration))
+
+    def finish(self) -> Optional[Dict[str, Any]]:
+        duration_ms = (time.perf_counter() - self.started) * 1000
+        stacks = None
+        if self.profiler is not None:
+            stacks = self.profiler.stop()
+            _sampler_slot.release()
+
+        repeated = Counter(statement for statement, _ in self.queries)
+        n_plus_one = [
+            {"statement": statement, "count": count}
+            for statement, count in repeated.most_common()
+            if count >= settings.PROFILE_N_PLUS_ONE_THRESHOLD
+        ]
+        if n_plus_one:
+            logger.warning("Possible N+1 queries in %s: %sx %s", self.name, n_plus_one[0]["count"], n_plus_one[0]["statement"][:200])
+
+        slow = duration_ms >= settings.PROFILE_SLOW_REQUEST_MS
+        if not (self.sampled or slow or n_plus_one):
+            return None
+        record = {
+            "id": uuid.uuid4().hex,
+            "kind": self.kind,
+            "name": self.name,
+            "started_at": self.started_at.isoformat(),
+            "duration_ms": round(duration_ms, 3),
+            "sampled": stacks is not None,
+            "whole_loop": self.whole_loop,
+            "slow": slow,
+            "query_count": len(self.queries),
+            "query_time_ms": round(sum(duration for _, duration in self.queries) * 1000, 3),
+            "queries": [
+                {"statement": statement, "duration_ms": round(duration * 1000, 3)}
+                for statement, duration in self.queries[:MAX_RECORDED_QUERIES]
+            ],
+            "n_plus_one": n_plus_one,
+            "stacks": stacks or {},
+        }
+        profiles.appendleft(record)
+        return record
+
+@contextmanager
+def capture(kind: str, name: str):
+    """Profile the enclosed block if profiling is enabled; keeps it if sampled, slow or N+1."""
+    if not settings.PROFILING_ENABLED:
+        yield None
+        return
+    current = Capture(kind, name, sampled=random.random() < settings.PROFILE_SAMPLE_RATE)
+    token = _current_capture.set(current)
+    current.start()
+    try:
+        yield current
+    finally:
+        _current_capture.reset(token)
+        current.finish()
+
+def get_profile(profile_id: str) -> Optional[Dict[str, Any]]:
+    for record in list(profiles):
+        if record["id"] == profile_id:
+            return record
+    return None
+
+def list_profiles() -> List[Dict[str, Any]]:
+    """Profile summaries without the bulky query and stack data."""
+    return [
+        {key: value for key, value in record.items() if key not in ("queries", "stacks")}
+        for record in list(profiles)
+    ]
+
+def to_collapsed(record: Dict[str, Any]) -> str:
+    """Stack samples in the collapsed format understood by flamegraph tools."""
+    return "\n".join(f"{stack} {count}" for stack, count in record["stacks"].items())
+
+class ProfilingMiddleware:
+    """ASGI middleware that captures HTTP requests when profiling is enabled."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not settings.PROFILING_ENABLED:
+            await self.app(scope, receive, send)
+            return
+        with capture("http", f"{scope['method']} {scope['path']}"):
+            await self.app(scope, receive, send)
+
+def _on_event_loop() -> bool:
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        current = _current_capture.get()
+        if current is not None:
+            context._profiling_thread = current.enter_thread()
+        context._profiling_started = time.perf_counter()
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    current = _current_capture.get()
+    started = getattr(context, "_profiling_started", None)
+    if current is not None and started is not None:
+        current.leave_thread(getattr(context, "_profiling_thread", None))
+        current.record_query(statement, time.perf_counter() - started)
+
+def _handle_error(exception_context):
+    # after_cursor_execute does not run for a failed statement
+    current = _current_capture.get()
+    context = exception_context.execution_context
+    if current is not None and context is not None:
+        current.leave_thread(getattr(context, "_profiling_thread", None))
+
+# Only hook SQL execution when profiling is on, so it costs nothing otherwise
+if settings.PROFILING_ENABLED:
+    event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(Engine, "handle_error", _handle_error)
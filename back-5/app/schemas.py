@@ -1,7 +1,7 @@
-from pydantic import BaseModel, EmailStr
+from pydantic import BaseModel, EmailStr, Field
 from datetime import datetime
 from typing import Optional, List
-from .models import MessageType
+from .models import MessageType, ScheduledMessageStatus, UploadStatus
 
 class ItemBase(BaseModel):
     name: str
@@ -41,6 +41,14 @@ class User(UserBase):
     class Config:
         from_attributes = True
 
+class UserSummary(BaseModel):
+    """What a client needs to display a user in search results."""
+    id: int
+    username: str
+
+    class Config:
+        from_attributes = True
+
 class MessageBase(BaseModel):
     receiver_id: int
     message_type: MessageType
@@ -58,6 +66,42 @@ class Message(MessageBase):
     class Config:
         from_attributes = True
 
+class ScheduledMessageCreate(BaseModel):
+    receiver_id: int
+    content: str
+    due_at: datetime
+
+class ScheduledMessage(ScheduledMessageCreate):
+    id: int
+    sender_id: int
+    status: ScheduledMessageStatus
+    message_id: Optional[int] = None
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
+class UploadCreate(BaseModel):
+    receiver_id: int
+    filename: str
+    content_type: Optional[str] = None
+    size: int = Field(gt=0)
+
+class UploadSession(BaseModel):
+    id: str
+    receiver_id: int
+    filename: str
+    content_type: Optional[str] = None
+    message_type: MessageType
+    size: int
+    offset: int
+    status: UploadStatus
+    message_id: Optional[int] = None
+    created_at: datetime
+
+    class Config:
+        from_attributes = True
+
 class WebSocketMessage(BaseModel):
     type: str
     content: Optional[str] = None
@@ -0,0 +1,30 @@
+"""
+Run the app under uvicorn, draining WebSocket connections on shutdown.
+
+uvicorn closes every open WebSocket as soon as it starts shutting down, before
+the app's shutdown event runs, so a drain there would find no sockets left.
+This server drains first, then lets uvicorn shut down as usual:
+
+    python -m app.server --host 0.0.0.0 --port 8000
+"""
+from typing import List, Optional
+import argparse
+import socket
+import uvicorn
+from .websocket import manager
+
+class Server(uvicorn.Server):
+    async def shutdown(self, sockets: Optional[List[socket.socket]] = None) -> None:
+        # Clients get a reconnect frame with jitter instead of a bare close
+        await manager.drain()
+        await super().shutdown(sockets=sockets)
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    args = parser.parse_args()
+    Server(uvicorn.Config("app.main:app", host=args.host, port=args.port)).run()
+
+if __name__ == "__main__":
+    main()
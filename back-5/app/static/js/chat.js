@@ -5,6 +5,7 @@ let selectedUser = null;
 let reconnectAttempts = 0;
 const MAX_RECONNECT_ATTEMPTS = 5;
 const RECONNECT_DELAY = 3000;
+let serverReconnectDelay = null; // Set by the server when it is restarting
 
 // Audio recording state
 let mediaRecorder = null;
@@ -110,7 +111,12 @@ function connectWebSocket(userId, token) {
         wsConnected = false;
         updateConnectionStatus(false);
         // Attempt to reconnect
-        if (reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
+        if (serverReconnectDelay !== null) {
+            // Planned restart: wait the server-chosen delay, doesn't count as a failure
+            const delay = serverReconnectDelay;
+            serverReconnectDelay = null;
+            setTimeout(() => connectWebSocket(currentUser.id, getToken()), delay);
+        } else if (reconnectAttempts < MAX_RECONNECT_ATTEMPTS) {
             reconnectAttempts++;
             setTimeout(() => {
                 console.log(`Attempting to reconnect (${reconnectAttempts}/${MAX_RECONNECT_ATTEMPTS})...`);
@@ -142,6 +148,9 @@ function handleWebSocketMessage(data) {
     }
     
     switch (data.type) {
+        case 'reconnect':
+            serverReconnectDelay = data.retry_after_ms;
+            break;
         case 'message':
             handleNewMessage(data);
             break;
@@ -0,0 +1,289 @@
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Hashable, List, Optional, Tuple
+from redis.exceptions import RedisError
+import asyncio
+import logging
+import math
+import time
+import uuid
+from . import crud, models
+from .cache import acquire_lease, renew_lease, release_lease
+from .config import settings
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
+
+def _timestamp(value: datetime) -> float:
+    # Naive datetimes come from SQLite and are UTC
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return value.timestamp()
+
+class TimingWheel:
+    """Hierarchical timing wheel.
+
+    Timers are hashed into `slots` buckets per level by their deadline tick;
+    level n covers deadlines up to slots ** (n + 1) ticks away. Adding and
+    cancelling are O(1), and each timer is moved down at most `levels - 1`
+    times before it expires, so the cost per timer does not depend on how
+    many timers are pending.
+    """
+
+    def __init__(self, tick: float, slot_bits: int = 6, levels: int = 4, origin: Optional[float] = None):
+        self.tick = tick
+        self.bits = slot_bits
+        self.slots = 1 << slot_bits
+        self.mask = self.slots - 1
+        self.levels = levels
+        self.origin = time.time() if origin is None else origin
+        self.current = 0  # Ticks since origin that have been processed
+        self._wheels: List[List[Dict[Hashable, int]]] = [
+            [{} for _ in range(self.slots)] for _ in range(levels)
+        ]
+        # timer_id -> (level, slot); level -1 means already due
+        self._locations: Dict[Hashable, Tuple[int, int]] = {}
+        self._due: Dict[Hashable, int] = {}
+
+    @property
+    def span(self) -> float:
+        """Furthest a deadline can be from now, in seconds."""
+        return self.tick * (self.slots ** self.levels - 1)
+
+    def __len__(self) -> int:
+        return len(self._locations)
+
+    def __contains__(self, timer_id: Hashable) -> bool:
+        return timer_id in self._locations
+
+    def add(self, timer_id: Hashable, deadline: float) -> bool:
+        """Schedule timer_id for a Unix timestamp; False if already scheduled or beyond the span."""
+        if timer_id in self._locations:
+            return False
+        deadline_tick = math.ceil((deadline - self.origin) / self.tick)
+        if deadline_tick - self.current >= self.slots ** self.levels:
+            return False
+        self._place(timer_id, deadline_tick)
+        return True
+
+    def cancel(self, timer_id: Hashable) -> bool:
+        location = self._locations.pop(timer_id, None)
+        if location is None:
+            return False
+        level, slot = location
+        if level < 0:
+            del self._due[timer_id]
+        else:
+            del self._wheels[level][slot][timer_id]
+        return True
+
+    def advance(self, now: float) -> List[Hashable]:
+        """Move the wheel up to `now` and return the IDs of the timers that expired."""
+        expired = self._pop_due()
+        target = int((now - self.origin) / self.tick)
+        while self.current < target:
+            self.current += 1
+            self._cascade()
+            expired.extend(self._pop_due())
+            bucket = self._wheels[0][self.current & self.mask]
+            if bucket:
+                self._wheels[0][self.current & self.mask] = {}
+                for timer_id in bucket:
+                    del self._locations[timer_id]
+                expired.extend(bucket)
+        return expired
+
+    def _place(self, timer_id: Hashable, deadline_tick: int) -> None:
+        delta = deadline_tick - self.current
+        if delta <= 0:
+            self._due[timer_id] = deadline_tick
+            self._locations[timer_id] = (-1, 0)
+            return
+        level = 0
+        while delta >= 1 << (self.bits * (level + 1)):
+            level += 1
+        slot = (deadline_tick >> (self.bits * level)) & self.mask
+        self._wheels[level][slot][timer_id] = deadline_tick
+        self._locations[timer_id] = (level, slot)
+
+    def _cascade(self) -> None:
+        # When the lower levels wrap around, the matching bucket of the level
+        # above now holds timers within reach of a lower level: redistribute it
+        for level in range(1, self.levels):
+            if self.current & ((1 << (self.bits * level)) - 1):
+                break
+            slot = (self.current >> (self.bits * level)) & self.mask
+            bucket = self._wheels[level][slot]
+            if bucket:
+                self._wheels[level][slot] = {}
+                for timer_id, deadline_tick in bucket.items():
+                    self._place(timer_id, deadline_tick)
+
+    def _pop_due(self) -> List[Hashable]:
+        if not self._due:
+            return []
+        expired = list(self._due)
+        self._due = {}
+        for timer_id in expired:
+            del self._locations[timer_id]
+        return expired
+
+class MessageScheduler:
+    """Delivers scheduled messages when they are due.
+
+    The process holding the Redis lease loads the pending messages due within
+    the horizon into a TimingWheel and delivers them from there; the others
+    just keep trying to take over the lease. Delivery stores a Message and
+    pushes it to whichever of the two users are connected to this process.
+    """
+
+    LEASE_KEY = "scheduler:lease"
+
+    def __init__(self, manager):
+        self.manager = manager
+        self.owner_id = uuid.uuid4().hex
+        self.is_owner = False
+        self.wheel: Optional[TimingWheel] = None
+        self._task: Optional[asyncio.Task] = None
+        self._deliveries: set = set()
+        self._delivery_slots = asyncio.Semaphore(20)
+        self._loaded_until: Optional[datetime] = None
+        self._max_seen_id = 0
+        self._next_refresh = 0.0
+        self._next_full_reload = 0.0
+        self._next_lease_check = 0.0
+
+    async def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+        if self._deliveries:
+            await asyncio.gather(*self._deliveries, return_exceptions=True)
+        if self.is_owner:
+            try:
+                await release_lease(self.LEASE_KEY, self.owner_id)
+            except RedisError as e:
+                logger.warning("Failed to release scheduler lease: %s", e)
+            self._lose_ownership()
+
+    def schedule(self, scheduled_id: int, due_at: datetime) -> None:
+        """Put a just-created message on the wheel if this process owns it.
+
+        Otherwise the owner picks it up on its next refresh.
+        """
+        if self.is_owner and self.wheel is not None:
+            deadline = _timestamp(due_at)
+            if deadline - time.time() <= settings.SCHEDULER_HORIZON_SECONDS:
+                self.wheel.add(scheduled_id, deadline)
+
+    def cancel(self, scheduled_id: int) -> None:
+        if self.wheel is not None:
+            self.wheel.cancel(scheduled_id)
+
+    async def _run(self) -> None:
+        while True:
+            try:
+                now = time.monotonic()
+                if now >= self._next_lease_check:
+                    await self._check_lease()
+                    self._next_lease_check = now + settings.SCHEDULER_LEASE_SECONDS / 3
+                if self.is_owner:
+                    if now >= self._next_refresh:
+                        await self._refresh(full=now >= self._next_full_reload)
+                        self._next_refresh = now + settings.SCHEDULER_REFRESH_SECONDS
+                    for scheduled_id in self.wheel.advance(time.time()):
+                        self._start_delivery(scheduled_id)
+                await asyncio.sleep(settings.SCHEDULER_TICK_SECONDS)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Scheduler loop error")
+                await asyncio.sleep(settings.SCHEDULER_REFRESH_SECONDS)
+
+    async def _check_lease(self) -> None:
+        ttl_ms = int(settings.SCHEDULER_LEASE_SECONDS * 1000)
+        try:
+            if self.is_owner:
+                if not await renew_lease(self.LEASE_KEY, self.owner_id, ttl_ms):
+                    logger.warning("Lost scheduler lease")
+                    self._lose_ownership()
+            elif await acquire_lease(self.LEASE_KEY, self.owner_id, ttl_ms):
+                logger.info("Acquired scheduler lease as %s", self.owner_id)
+                self.is_owner = True
+                self.wheel = TimingWheel(settings.SCHEDULER_TICK_SECONDS)
+                self._next_refresh = 0.0
+                self._next_full_reload = 0.0
+        except RedisError as e:
+            # Without Redis we can't prove we are the only owner
+            if self.is_owner:
+                logger.warning("Scheduler lease check failed, stepping down: %s", e)
+                self._lose_ownership()
+
+    def _lose_ownership(self) -> None:
+        self.is_owner = False
+        self.wheel = None
+        self._loaded_until = None
+        self._max_seen_id = 0
+
+    async def _refresh(self, full: bool) -> None:
+        """Load pending messages that entered the horizon or were created since the last refresh."""
+        until = datetime.now(timezone.utc) + timedelta(seconds=settings.SCHEDULER_HORIZON_SECONDS)
+        # A full reload also catches rows whose transactions committed out of ID order
+        loaded_until = None if full else self._loaded_until
+        upcoming = await asyncio.to_thread(self._load_upcoming, until, loaded_until, self._max_seen_id)
+        if not self.is_owner:
+            return
+        for scheduled_id, due_at in upcoming:
+            if scheduled_id not in self.wheel:
+                self.wheel.add(scheduled_id, _timestamp(due_at))
+            self._max_seen_id = max(self._max_seen_id, scheduled_id)
+        self._loaded_until = until
+        if full:
+            self._next_full_reload = time.monotonic() + settings.SCHEDULER_FULL_RELOAD_SECONDS
+
+    @staticmethod
+    def _load_upcoming(until: datetime, loaded_until: Optional[datetime], after_id: int) -> List[tuple]:
+        with SessionLocal() as db:
+            return crud.get_upcoming_scheduled_messages(db, until, loaded_until=loaded_until, after_id=after_id)
+
+    @staticmethod
+    def _store(scheduled_id: int) -> Optional[models.Message]:
+        with SessionLocal() as db:
+            return crud.deliver_scheduled_message(db, scheduled_id)
+
+    def _start_delivery(self, scheduled_id: int) -> None:
+        task = asyncio.create_task(self._deliver(scheduled_id))
+        self._deliveries.add(task)
+        task.add_done_callback(self._deliveries.discard)
+
+    async def _deliver(self, scheduled_id: int) -> None:
+        async with self._delivery_slots:
+            try:
+                message = await asyncio.to_thread(self._store, scheduled_id)
+            except Exception:
+                logger.exception("Failed to deliver scheduled message %s", scheduled_id)
+                return
+            if message is None:
+                # Cancelled, or already delivered
+                return
+            await crud.cache_new_message(message)
+            message_data = {
+                "type": "message",
+                "id": message.id,
+                "from_user": message.sender_id,
+                "to_user": message.receiver_id,
+                "content": message.content,
+                "message_type": "TEXT",
+                "timestamp": message.created_at.isoformat(),
+                "scheduled_id": scheduled_id
+            }
+            await self.manager.send_personal_message(message_data, message.receiver_id)
+            await self.manager.send_personal_message(message_data, message.sender_id)
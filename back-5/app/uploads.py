@@ -0,0 +1,164 @@
+from datetime import datetime
+from fastapi import HTTPException, status
+from pathlib import Path
+from typing import AsyncIterator, Optional, Tuple
+import base64
+import binascii
+import errno
+import hashlib
+import logging
+import os
+import shutil
+import time
+import uuid
+import aiofiles
+from . import models
+from .config import settings
+
+logger = logging.getLogger(__name__)
+
+MEDIA_DIR = Path("app/static/media")
+
+# Algorithms accepted in the Upload-Checksum header, e.g. "sha256 <base64 digest>"
+CHECKSUM_ALGORITHMS = {"md5", "sha1", "sha256"}
+
+# Status for a chunk whose checksum does not match, as in the tus protocol
+HTTP_460_CHECKSUM_MISMATCH = 460
+
+class IncompleteUploadError(Exception):
+    """The temp file does not hold exactly the bytes the upload says were received."""
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp'}
+
+def temp_path(upload_id: str) -> Path:
+    return Path(settings.UPLOAD_TEMP_DIR) / f"{upload_id}.part"
+
+def create_temp_file(upload_id: str) -> None:
+    Path(settings.UPLOAD_TEMP_DIR).mkdir(parents=True, exist_ok=True)
+    temp_path(upload_id).touch(exist_ok=False)
+
+def remove_temp_file(upload_id: str) -> None:
+    temp_path(upload_id).unlink(missing_ok=True)
+
+def message_type_for(filename: str, content_type: Optional[str]) -> models.MessageType:
+    """Message type for an uploaded file, from its extension and MIME type."""
+    content_type = content_type or ""
+    if Path(filename).suffix.lower() in IMAGE_EXTENSIONS or content_type.startswith("image/"):
+        return models.MessageType.IMAGE
+    if content_type.startswith("audio/"):
+        return models.MessageType.VOICE
+    if content_type.startswith("video/"):
+        return models.MessageType.VIDEO
+    return models.MessageType.TEXT
+
+def parse_checksum(header: Optional[str]) -> Optional[Tuple[str, bytes]]:
+    """Parse an Upload-Checksum header into (algorithm, digest)."""
+    if not header:
+        return None
+    try:
+        algorithm, encoded = header.split(" ", 1)
+        digest = base64.b64decode(encoded.strip(), validate=True)
+    except (ValueError, binascii.Error):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Malformed Upload-Checksum header")
+    algorithm = algorithm.lower()
+    if algorithm not in CHECKSUM_ALGORITHMS:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=f"Unsupported checksum algorithm: {algorithm}")
+    return algorithm, digest
+
+async def write_chunk(
+    upload_id: str,
+    offset: int,
+    max_bytes: int,
+    body: AsyncIterator[bytes],
+    checksum: Optional[Tuple[str, bytes]] = None
+) -> int:
+    """Stream a request body into the upload's temp file at offset.
+
+    The caller must hold the upload's writer claim (crud.claim_upload_writer)
+    and, if this fails, truncate the file back to offset while it still
+    holds it. Anything past offset, left by a writer that died, is dropped
+    first. The body is written as it arrives, never buffered whole. Returns
+    the number of bytes written.
+    """
+    hasher = hashlib.new(checksum[0]) if checksum else None
+    written = 0
+    try:
+        f = await aiofiles.open(temp_path(upload_id), "r+b")
+    except FileNotFoundError:
+        # Removed by the stale upload cleanup
+        raise HTTPException(status_code=status.HTTP_410_GONE, detail="Upload expired")
+    try:
+        await f.truncate(offset)
+        await f.seek(offset)
+        async for data in body:
+            written += len(data)
+            if written > max_bytes:
+                raise HTTPException(status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, detail="Chunk too large")
+            await f.write(data)
+            if hasher is not None:
+                hasher.update(data)
+        if hasher is not None and hasher.digest() != checksum[1]:
+            raise HTTPException(status_code=HTTP_460_CHECKSUM_MISMATCH, detail="Checksum mismatch")
+    finally:
+        await f.close()
+    return written
+
+async def truncate_temp_file(upload_id: str, size: int) -> None:
+    """Drop a failed chunk; only call this while holding the upload's writer claim."""
+    try:
+        f = await aiofiles.open(temp_path(upload_id), "r+b")
+    except FileNotFoundError:
+        return
+    try:
+        await f.truncate(size)
+    finally:
+        await f.close()
+
+def finalize(upload_id: str, size: int, filename: str) -> str:
+    """Move a fully received upload into the media directory and return its new name.
+
+    The temp file already holds the chunks in place, so this is a rename,
+    not a copy. Raises IncompleteUploadError if the file is not exactly
+    `size` bytes: it is never padded or cut to fit.
+    """
+    MEDIA_DIR.mkdir(parents=True, exist_ok=True)
+    ext = Path(filename or 'file').suffix or '.bin'
+    unique_name = f"{datetime.now().strftime('%Y%m%d%H%M%S')}_{uuid.uuid4().hex[:8]}{ext}"
+    source = temp_path(upload_id)
+    with open(source, "r+b") as f:
+        actual = os.fstat(f.fileno()).st_size
+        if actual != size:
+            raise IncompleteUploadError(f"Upload {upload_id} has {actual} of {size} bytes")
+        os.fsync(f.fileno())
+    try:
+        os.replace(source, MEDIA_DIR / unique_name)
+    except OSError as e:
+        # UPLOAD_TEMP_DIR is on another filesystem: fall back to a copy
+        if e.errno != errno.EXDEV:
+            raise
+        logger.warning("Upload temp dir is on another filesystem than %s, copying %s", MEDIA_DIR, upload_id)
+        shutil.move(str(source), str(MEDIA_DIR / unique_name))
+    return unique_name
+
+def remove_media_file(name: str) -> None:
+    (MEDIA_DIR / name).unlink(missing_ok=True)
+
+def cleanup_stale_files(max_age_seconds: float) -> int:
+    """Remove temp files that have not been written to for max_age_seconds.
+
+    Catches files whose session row is gone, e.g. when creating the session
+    failed after the file was made.
+    """
+    temp_dir = Path(settings.UPLOAD_TEMP_DIR)
+    if not temp_dir.exists():
+        return 0
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for path in temp_dir.glob("*.part"):
+        try:
+            if path.stat().st_mtime < cutoff:
+                path.unlink()
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
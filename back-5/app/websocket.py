@@ -1,11 +1,15 @@
 from fastapi import WebSocket, WebSocketDisconnect, HTTPException, Depends
 from typing import Dict, List, Optional
+from contextlib import asynccontextmanager
+import asyncio
 import json
+import random
 from datetime import datetime
 import logging
 from sqlalchemy.orm import Session
 from . import crud, models, schemas
 from .database import get_db
+from .config import settings
 
 logger = logging.getLogger(__name__)
 
@@ -15,22 +19,85 @@ class ConnectionManager:
         self.active_connections: Dict[int, WebSocket] = {}
         # Store user status
         self.user_status: Dict[int, str] = {}
+        # Set while the process is shutting down; new sockets are refused
+        self.draining = False
+        # Frames currently being handled (DB writes and outbound sends)
+        self._in_flight = 0
+        self._idle = asyncio.Event()
+        self._idle.set()
 
-    async def connect(self, websocket: WebSocket, user_id: int):
+    async def connect(self, websocket: WebSocket, user_id: int) -> bool:
         """Connect a new WebSocket connection."""
+        if self.draining:
+            # 1012 = service restart: tell the client to come back later
+            await websocket.close(code=1012)
+            return False
         await websocket.accept()
         self.active_connections[user_id] = websocket
         self.user_status[user_id] = "online"
         # Notify all users about the new connection
         await self.broadcast_status(user_id, "online")
+        return True
 
     async def disconnect(self, user_id: int):
         """Disconnect a WebSocket connection."""
         if user_id in self.active_connections:
             del self.active_connections[user_id]
             self.user_status[user_id] = "offline"
-            # Notify all users about the disconnection
-            await self.broadcast_status(user_id, "offline")
+            # Notify all users about the disconnection, unless everyone is
+            # being disconnected anyway
+            if not self.draining:
+                await self.broadcast_status(user_id, "offline")
+
+    @asynccontextmanager
+    async def in_flight(self):
+        """Track a frame being handled so draining can wait for it to finish."""
+        self._in_flight += 1
+        self._idle.clear()
+        try:
+            yield
+        finally:
+            self._in_flight -= 1
+            if self._in_flight == 0:
+                self._idle.set()
+
+    async def drain(self):
+        """Close every connection for a rolling deploy.
+
+        New connections are refused, in-flight frames are allowed to finish,
+        and each client is told to reconnect after a random delay so the
+        next instance does not get all of them at once. Sockets are closed
+        in batches without per-user presence broadcasts.
+        """
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout=settings.DRAIN_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning("Draining with %s frames still in flight", self._in_flight)
+
+        user_ids = list(self.active_connections.keys())
+        batch_size = max(1, settings.DRAIN_BATCH_SIZE)
+        for start in range(0, len(user_ids), batch_size):
+            batch = user_ids[start:start + batch_size]
+            await asyncio.gather(*(self._close_for_restart(user_id) for user_id in batch))
+            if start + batch_size < len(user_ids):
+                await asyncio.sleep(settings.DRAIN_BATCH_INTERVAL_SECONDS)
+
+    async def _close_for_restart(self, user_id: int):
+        connection = self.active_connections.pop(user_id, None)
+        self.user_status[user_id] = "offline"
+        if connection is None:
+            return
+        reconnect_message = {
+            "type": "reconnect",
+            "retry_after_ms": random.randint(0, settings.DRAIN_RECONNECT_JITTER_MS)
+        }
+        try:
+            await connection.send_json(reconnect_message)
+            await connection.close(code=1012)
+        except Exception as e:
+            # The client is going away either way
+            logger.debug("Error closing connection for user %s: %s", user_id, e)
 
     async def send_personal_message(self, message: dict, user_id: int):
         """Send a message to a specific user."""
@@ -40,20 +107,20 @@ class ConnectionManager:
             except WebSocketDisconnect:
                 await self.disconnect(user_id)
             except Exception as e:
-                logger.error(f"Error sending message to user {user_id}: {str(e)}")
+                logger.error("Error sending message to user %s: %s", user_id, e)
                 await self.disconnect(user_id)
 
     async def broadcast(self, message: dict, exclude_user_id: Optional[int] = None):
         """Broadcast a message to all users except the excluded one."""
         disconnected_users = []
-        for user_id, connection in self.active_connections.items():
+        for user_id, connection in list(self.active_connections.items()):
             if user_id != exclude_user_id:
                 try:
                     await connection.send_json(message)
                 except WebSocketDisconnect:
                     disconnected_users.append(user_id)
                 except Exception as e:
-                    logger.error(f"Error broadcasting to user {user_id}: {str(e)}")
+                    logger.error("Error broadcasting to user %s: %s", user_id, e)
                     disconnected_users.append(user_id)
         
         # Clean up disconnected users
@@ -101,7 +168,7 @@ class ConnectionManager:
             await self.send_personal_message(message_data, sender_id)
 
         except Exception as e:
-            logger.error(f"Error handling text message: {str(e)}")
+            logger.error("Error handling text message: %s", e)
             error_message = {
                 "type": "error",
                 "message": "Failed to send message",
@@ -140,7 +207,7 @@ class ConnectionManager:
             await self.send_personal_message(message_data, sender_id)
 
         except Exception as e:
-            logger.error(f"Error handling voice message: {str(e)}")
+            logger.error("Error handling voice message: %s", e)
             error_message = {
                 "type": "error",
                 "message": "Failed to send voice message",
@@ -179,7 +246,7 @@ class ConnectionManager:
             await self.send_personal_message(message_data, sender_id)
 
         except Exception as e:
-            logger.error(f"Error handling video message: {str(e)}")
+            logger.error("Error handling video message: %s", e)
             error_message = {
                 "type": "error",
                 "message": "Failed to send video message",
@@ -1,5 +1,12 @@
 from celery import Celery
+from datetime import datetime, timedelta, timezone
+import logging
 import os
+from . import crud, uploads
+from .config import settings
+from .database import SessionLocal
+
+logger = logging.getLogger(__name__)
 
 celery_app = Celery(
     "worker",
@@ -12,5 +19,35 @@ celery_app.conf.task_routes = {
 }
 
 celery_app.conf.beat_schedule = {
-    # Add periodic tasks here if needed
-} 
\ No newline at end of file
+    "cleanup-stale-uploads": {
+        "task": "app.worker.cleanup_stale_uploads",
+        "schedule": settings.UPLOAD_CLEANUP_INTERVAL_SECONDS,
+    },
+}
+
+@celery_app.task(name="app.worker.cleanup_stale_uploads")
+def cleanup_stale_uploads():
+    """Delete upload sessions untouched for UPLOAD_SESSION_TTL_SECONDS, and their temp files."""
+    before = datetime.now(timezone.utc) - timedelta(seconds=settings.UPLOAD_SESSION_TTL_SECONDS)
+    with SessionLocal() as db:
+        unfinished = crud.delete_stale_upload_sessions(db, before)
+    for upload_id in unfinished:
+        uploads.remove_temp_file(upload_id)
+    orphaned = uploads.cleanup_stale_files(settings.UPLOAD_SESSION_TTL_SECONDS)
+    logger.info("Removed %s stale uploads and %s orphaned upload files", len(unfinished), orphaned)
+    return {"sessions": len(unfinished), "files": orphaned}
+
+@celery_app.task(name="app.worker.recompress_messages")
+def recompress_messages(after_id: int = 0):
+    """Compress stored messages in batches, e.g. after enabling compression or adding a dictionary.
+
+    Start it with recompress_messages.delay(); each batch queues the next one.
+    """
+    with SessionLocal() as db:
+        last_id, rewritten = crud.recompress_messages(db, after_id, settings.RECOMPRESS_BATCH_SIZE)
+    if last_id is None:
+        logger.info("Recompressing messages finished")
+        return {"last_id": after_id, "rewritten": 0}
+    logger.info("Recompressed %s messages up to id %s", rewritten, last_id)
+    recompress_messages.delay(after_id=last_id)
+    return {"last_id": last_id, "rewritten": rewritten}
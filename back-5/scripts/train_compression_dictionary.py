@@ -0,0 +1,63 @@
+"""
+Train a zstd dictionary on recent message texts.
+
+Short messages compress poorly on their own; with a dictionary trained on
+typical messages even a few dozen bytes shrink. Writes <id>.zdict to the
+output directory. To use it, point COMPRESSION_DICTIONARY_DIR at that
+directory on every instance, set COMPRESSION_DICTIONARY_ID to the printed ID,
+then run the app.worker.recompress_messages task to rewrite existing rows.
+
+    python scripts/train_compression_dictionary.py --out-dir app/dictionaries
+
+Keep old dictionaries in the directory for as long as rows compressed with
+them may exist.
+"""
+import argparse
+import os
+import sys
+from pathlib import Path
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from app import models
+from app.config import settings
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--database-url", default=settings.DATABASE_URL)
+    parser.add_argument("--samples", type=int, default=50000, help="Number of recent messages to train on")
+    parser.add_argument("--size", type=int, default=16 * 1024, help="Dictionary size in bytes")
+    parser.add_argument("--out-dir", default=settings.COMPRESSION_DICTIONARY_DIR or "app/dictionaries")
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    try:
+        import zstandard
+    except ImportError:
+        sys.exit("zstandard is not installed: pip install zstandard")
+
+    engine = create_engine(args.database_url)
+    with sessionmaker(bind=engine)() as session:
+        # Content is decompressed by the column type
+        rows = session.query(models.Message.content).filter(
+            models.Message.message_type == models.MessageType.TEXT,
+            models.Message.content.isnot(None)
+        ).order_by(models.Message.id.desc()).limit(args.samples).all()
+    samples = [row.content.encode("utf-8") for row in rows if row.content]
+    if len(samples) < 100:
+        sys.exit(f"Only {len(samples)} messages to train on, need at least 100")
+
+    dictionary = zstandard.train_dictionary(args.size, samples)
+    out_dir = Path(args.out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    path = out_dir / f"{dictionary.dict_id()}.zdict"
+    path.write_bytes(dictionary.as_bytes())
+    print(f"Trained on {len(samples)} messages, wrote {path}")
+    print(f"Set COMPRESSION_DICTIONARY_DIR={out_dir} and COMPRESSION_DICTIONARY_ID={dictionary.dict_id()}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,49 @@
+import zlib
+from app import compression
+from app.config import settings
+
+def test_text_round_trip():
+    long_text = "2026-01-01 12:00:00 INFO request handled in 12ms\n" * 40
+    stored = compression.compress_text(long_text)
+    assert stored.startswith(compression.TEXT_MARKER)
+    assert len(stored) < len(long_text) / 4
+    assert compression.decompress_text(stored) == long_text
+
+    # Short texts are stored as they are, and existing plain rows read back unchanged
+    assert compression.compress_text("hi there") == "hi there"
+    assert compression.decompress_text("hi there") == "hi there"
+
+    # Text that starts with the marker itself is escaped
+    tricky = compression.TEXT_MARKER + "hello"
+    assert compression.compress_text(tricky) != tricky
+    assert compression.decompress_text(compression.compress_text(tricky)) == tricky
+
+def test_binary_skips_compressed_formats():
+    wav = b"RIFF\x00\x00\x00\x00WAVEfmt " + bytes(4096)
+    stored = compression.compress_bytes(wav)
+    assert stored.startswith(compression.MAGIC)
+    assert compression.decompress_bytes(stored) == wav
+
+    jpeg = b"\xff\xd8\xff\xe0" + bytes(4096)
+    assert compression.compress_bytes(jpeg) == jpeg
+    assert compression.decompress_bytes(jpeg) == jpeg
+
+    # Media from before compression that happens to start with MAGIC reads back unchanged
+    for legacy in (compression.MAGIC + b"\x07data", compression.MAGIC + bytes([compression.ZLIB]) + b"not zlib",
+                   compression.MAGIC + bytes([compression.ZSTD_DICT]) + b"\x00",
+                   compression.MAGIC + bytes([compression.ZSTD_DICT]) + b"\x00\x00\x00\x05compressed?",
+                   compression.MAGIC + bytes([compression.RAW]), compression.MAGIC + bytes([compression.RAW]) + b"data"):
+        assert compression.decompress_bytes(legacy) == legacy
+
+def test_legacy_text_starting_with_the_marker():
+    marker = compression.TEXT_MARKER
+    for legacy in (marker, marker + "a", marker + "0000000000", marker + "not base85 ~~~"):
+        assert compression.decompress_text(legacy) == legacy
+
+def test_reads_older_format_versions(monkeypatch):
+    monkeypatch.setattr(settings, "COMPRESSION_CODEC", "zlib")
+    data = b"voice " * 1000
+    stored = compression.MAGIC + bytes([compression.ZLIB]) + zlib.compress(data)
+    assert compression.stored_version(stored) == compression.ZLIB
+    assert compression.decompress_bytes(stored) == data
+    assert compression.compress_bytes(data) == stored[:len(compression.MAGIC) + 1] + zlib.compress(data, settings.COMPRESSION_LEVEL)
@@ -0,0 +1,36 @@
+import json
+import logging
+import queue
+from app.log import JSONFormatter, LazyQueueHandler, RateLimitFilter, request_id_var
+
+def test_queue_handler_defers_formatting_and_adds_context():
+    log_queue = queue.Queue()
+    handler = LazyQueueHandler(log_queue)
+    token = request_id_var.set("req-1")
+    try:
+        handler.handle(logging.LogRecord("app.test", logging.INFO, __file__, 1, "user %s sent %d bytes", ("alice", 10), None))
+        handler.handle(logging.LogRecord("app.test", logging.INFO, __file__, 2, "payload %s", ([1, 2],), None))
+    finally:
+        request_id_var.reset(token)
+
+    deferred, snapshot = log_queue.get_nowait(), log_queue.get_nowait()
+    assert deferred.args == ("alice", 10)
+    # Mutable arguments are formatted at the call
+    assert snapshot.msg == "payload [1, 2]" and snapshot.args is None
+
+    entry = json.loads(JSONFormatter().format(deferred))
+    assert entry["message"] == "user alice sent 10 bytes"
+    assert entry["request_id"] == "req-1"
+    assert "connection_id" not in entry
+
+def test_rate_limit_counts_suppressed_records():
+    rate_limit = RateLimitFilter(per_second=0.001, burst=2)
+
+    def record():
+        return logging.LogRecord("app.test", logging.ERROR, __file__, 1, "send to %s failed", (1,), None)
+
+    assert [rate_limit.filter(record()) for _ in range(5)] == [True, True, False, False, False]
+    rate_limit._buckets[("send to %s failed", logging.ERROR)][0] = 1
+    allowed = record()
+    assert rate_limit.filter(allowed)
+    assert allowed.suppressed == 3
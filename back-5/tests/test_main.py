@@ -1,5 +1,14 @@
 from fastapi.testclient import TestClient
 from app.main import app
+from app import cache, crud, uploads
+from app.config import settings
+from app.database import SessionLocal, engine, is_pinned_to_primary, replica_router
+import asyncio
+import base64
+import hashlib
+import httpx
+import pytest
+import uuid
 
 client = TestClient(app)
 
@@ -10,4 +19,121 @@ def test_read_main():
 def test_health_check():
     response = client.get("/health")
     assert response.status_code == 200
-    assert response.json() == {"status": "healthy"} 
\ No newline at end of file
+    assert response.json() == {"status": "healthy"} 
+
+def test_read_items_conditional_get():
+    client.post("/items/", json={"name": "etag item"})
+    response = client.get("/items/")
+    assert response.status_code == 200
+    etag = response.headers["etag"]
+    assert "no-cache" in response.headers["cache-control"]
+
+    response = client.get("/items/", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["etag"] == etag
+
+    client.post("/items/", json={"name": "another etag item"})
+    response = client.get("/items/", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["etag"] != etag
+
+def test_websocket_writes_pin_the_sender_to_primary(monkeypatch):
+    monkeypatch.setattr(replica_router, "engines", [engine])
+    users = []
+    for _ in range(2):
+        username = f"ws_{uuid.uuid4().hex[:8]}"
+        user_id = client.post("/users/", json={"username": username, "email": f"{username}@example.com", "password": "secret"}).json()["id"]
+        users.append((username, user_id))
+    (sender, sender_id), (_, receiver_id) = users
+    token = client.post("/token", data={"username": sender, "password": "secret"}).json()["access_token"]
+    with client.websocket_connect(f"/ws/{sender_id}?token={token}") as websocket:
+        websocket.send_json({"target_id": receiver_id, "content": "hi"})
+        while websocket.receive_json()["type"] != "message":
+            pass
+    assert is_pinned_to_primary(sender)
+
+def test_replica_reads_never_fill_the_item_cache(monkeypatch):
+    fakeredis = pytest.importorskip("fakeredis")
+    monkeypatch.setattr(cache, "redis_client", fakeredis.aioredis.FakeRedis())
+    item_id = client.post("/items/", json={"name": "replicated item"}).json()["id"]
+
+    async def scenario():
+        replica = SessionLocal()
+        replica.info["replica"] = True
+        try:
+            assert (await crud.get_item(replica, item_id)).name == "replicated item"
+        finally:
+            replica.close()
+        assert await cache.get_cache(f"item:{item_id}") is None
+
+    asyncio.run(scenario())
+
+def test_resumable_upload_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_TEMP_DIR", str(tmp_path))
+    username = f"uploader_{uuid.uuid4().hex[:8]}"
+    user_id = client.post("/users/", json={"username": username, "email": f"{username}@example.com", "password": "secret"}).json()["id"]
+    token = client.post("/token", data={"username": username, "password": "secret"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+
+    data = b"voice message " * 100
+    response = client.post("/uploads/", json={"receiver_id": user_id, "filename": "voice.ogg", "content_type": "audio/ogg", "size": len(data)}, headers=headers)
+    assert response.status_code == 201
+    upload_id = response.json()["id"]
+
+    chunk = data[:500]
+    checksum = "sha256 " + base64.b64encode(hashlib.sha256(chunk).digest()).decode()
+    response = client.put(f"/uploads/{upload_id}", content=chunk, headers={**headers, "Upload-Offset": "0", "Upload-Checksum": checksum})
+    assert response.status_code == 204
+    assert response.headers["upload-offset"] == "500"
+
+    # A resend of the same chunk is rejected with the offset to resume from
+    response = client.put(f"/uploads/{upload_id}", content=chunk, headers={**headers, "Upload-Offset": "0"})
+    assert response.status_code == 409
+    assert response.headers["upload-offset"] == "500"
+
+    response = client.put(f"/uploads/{upload_id}", content=data[500:], headers={**headers, "Upload-Offset": "500", "Upload-Checksum": checksum})
+    assert response.status_code == 460
+
+    response = client.get(f"/uploads/{upload_id}", headers=headers)
+    assert response.json()["offset"] == 500
+    assert (tmp_path / f"{upload_id}.part").read_bytes() == chunk
+
+
+def test_chunk_writes_to_an_upload_are_serialized(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, "UPLOAD_TEMP_DIR", str(tmp_path))
+    username = f"uploader_{uuid.uuid4().hex[:8]}"
+    user_id = client.post("/users/", json={"username": username, "email": f"{username}@example.com", "password": "secret"}).json()["id"]
+    token = client.post("/token", data={"username": username, "password": "secret"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}", "Upload-Offset": "0"}
+    data = bytes(range(256)) * 4
+    upload_id = client.post("/uploads/", json={"receiver_id": user_id, "filename": "clip.webm", "content_type": "video/webm", "size": len(data)}, headers=headers).json()["id"]
+
+    async def scenario():
+        streaming = asyncio.Event()
+        dropped = asyncio.Event()
+
+        async def dropped_connection():
+            yield data[:100]
+            streaming.set()
+            await dropped.wait()
+            raise ConnectionResetError("client went away")
+
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://testserver") as http:
+            original = asyncio.create_task(http.put(f"/uploads/{upload_id}", content=dropped_connection(), headers=headers))
+            await streaming.wait()
+            # A retry while the original is still streaming must not write
+            retry = await http.put(f"/uploads/{upload_id}", content=data[:500], headers=headers)
+            assert retry.status_code == 409
+            dropped.set()
+            with pytest.raises(ConnectionResetError):
+                await original
+            retry = await http.put(f"/uploads/{upload_id}", content=data[:500], headers=headers)
+            assert retry.status_code == 204
+
+    asyncio.run(scenario())
+    assert (tmp_path / f"{upload_id}.part").read_bytes() == data[:500]
+
+    # A file that is not exactly the upload's size is never completed
+    with pytest.raises(uploads.IncompleteUploadError):
+        uploads.finalize(upload_id, len(data), "clip.webm")
+    assert (tmp_path / f"{upload_id}.part").exists()
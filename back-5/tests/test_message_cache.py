@@ -0,0 +1,173 @@
+import asyncio
+import uuid
+from datetime import timedelta
+import pytest
+from app import cache, crud, models, schemas
+from app.config import settings
+from app.database import SessionLocal, engine
+
+fakeredis = pytest.importorskip("fakeredis")
+
+models.Base.metadata.create_all(bind=engine)
+
+@pytest.fixture
+def conversation(monkeypatch):
+    monkeypatch.setattr(cache, "redis_client", fakeredis.aioredis.FakeRedis())
+    monkeypatch.setattr(settings, "MESSAGE_CACHE_SIZE", 3)
+    db = SessionLocal()
+    users = []
+    for _ in range(2):
+        username = f"cache_{uuid.uuid4().hex[:8]}"
+        users.append(models.User(username=username, email=f"{username}@example.com", hashed_password="x"))
+    db.add_all(users)
+    db.commit()
+    yield db, users[0].id, users[1].id
+    db.close()
+
+def store(db, sender_id, receiver_id, content):
+    """Insert a message without the write-through to the cache."""
+    message = models.Message(sender_id=sender_id, receiver_id=receiver_id, message_type=models.MessageType.TEXT, content=content)
+    db.add(message)
+    db.commit()
+    db.refresh(message)
+    return message
+
+async def send(db, sender_id, receiver_id, content):
+    message = schemas.MessageCreate(receiver_id=receiver_id, content=content, message_type=models.MessageType.TEXT)
+    return await crud.create_message(db, message, sender_id=sender_id)
+
+async def history(db, user1_id, user2_id, skip=0):
+    messages = await crud.get_messages_between_users_cached(db, user1_id, user2_id, skip=skip)
+    return [message["content"] if isinstance(message, dict) else message.content for message in messages]
+
+def test_history_is_served_from_the_cache(conversation):
+    db, alice, bob = conversation
+
+    async def scenario():
+        for content in ("1", "2", "3"):
+            await send(db, alice, bob, content)
+        assert await history(db, alice, bob) == ["1", "2", "3"]
+        await send(db, bob, alice, "4")
+        # Only the newest MESSAGE_CACHE_SIZE messages are cached
+        assert await history(db, alice, bob) == ["1", "2", "3", "4"]
+        key = crud._conversation_cache_key(alice, bob)
+        cached, count = await cache.get_counted_list(key, crud._conversation_count_key(key))
+        assert [message["content"] for message in cached] == ["2", "3", "4"]
+        assert count == 4
+
+        # A hit does not query the messages again
+        queries = []
+        original = crud._refill_conversation_cache
+        async def refill(*args):
+            queries.append(args)
+            return await original(*args)
+        crud._refill_conversation_cache = refill
+        try:
+            assert await history(db, alice, bob) == ["1", "2", "3", "4"]
+        finally:
+            crud._refill_conversation_cache = original
+        assert queries == []
+
+    asyncio.run(scenario())
+
+def test_refill_from_an_older_snapshot_is_not_trusted(conversation):
+    db, alice, bob = conversation
+
+    async def scenario():
+        for content in ("1", "2", "3"):
+            await send(db, alice, bob, content)
+        assert await history(db, alice, bob) == ["1", "2", "3"]
+
+        # A refill read its rows before message 4 committed, and replaced the
+        # list after 4's write-through: the list lost 4 but has a full length
+        store(db, alice, bob, "4")
+        key = crud._conversation_cache_key(alice, bob)
+        await cache.replace_list(key, [crud._serialize_message(m) for m in crud.get_messages_between_users(db, alice, bob)[:3]],
+                                 count_key=crud._conversation_count_key(key), count=3)
+        await send(db, alice, bob, "5")
+
+        # The newest page is within the cached window
+        assert await history(db, alice, bob, skip=2) == ["3", "4", "5"]
+        cached, count = await cache.get_counted_list(key, crud._conversation_count_key(key))
+        assert [message["content"] for message in cached] == ["3", "4", "5"]
+        assert count == 5
+
+    asyncio.run(scenario())
+
+def test_replica_reads_never_fill_the_cache(conversation):
+    db, alice, bob = conversation
+
+    async def scenario():
+        for content in ("1", "2"):
+            store(db, alice, bob, content)
+        replica = SessionLocal()
+        replica.info["replica"] = True
+        try:
+            assert await history(replica, alice, bob) == ["1", "2"]
+        finally:
+            replica.close()
+        key = crud._conversation_cache_key(alice, bob)
+        assert await cache.get_counted_list(key, crud._conversation_count_key(key)) == (None, None)
+
+        # The primary does fill it
+        assert await history(db, alice, bob) == ["1", "2"]
+        cached, count = await cache.get_counted_list(key, crud._conversation_count_key(key))
+        assert [message["content"] for message in cached] == ["1", "2"]
+        assert count == 2
+
+    asyncio.run(scenario())
+
+
+def test_history_is_in_id_order(conversation):
+    db, alice, bob = conversation
+
+    async def scenario():
+        for content in ("1", "2"):
+            await send(db, alice, bob, content)
+        # Committed last, but its transaction started first (created_at is
+        # the transaction start time on Postgres)
+        late = await send(db, bob, alice, "3")
+        late.created_at = late.created_at - timedelta(minutes=5)
+        db.commit()
+        assert await history(db, alice, bob) == ["1", "2", "3"]
+
+        refills = []
+        original = crud._refill_conversation_cache
+        async def refill(*args):
+            refills.append(args)
+            return await original(*args)
+        crud._refill_conversation_cache = refill
+        try:
+            assert await history(db, alice, bob) == ["1", "2", "3"]
+        finally:
+            crud._refill_conversation_cache = original
+        assert refills == []
+
+    asyncio.run(scenario())
+
+def test_values_from_another_serializer_are_misses(conversation, monkeypatch):
+    db, alice, bob = conversation
+
+    async def scenario():
+        for content in ("1", "2"):
+            await send(db, alice, bob, content)
+        assert await history(db, alice, bob) == ["1", "2"]
+        await cache.set_cache("json-value", {"a": 1})
+
+        # Switched to msgpack, e.g. mid-rollout: existing JSON values are misses
+        monkeypatch.setattr(cache, "serializer", cache.get_serializer("msgpack"))
+        assert await cache.get_cache("json-value") is None
+        assert await cache.redis_client.exists("json-value") == 0
+        assert await history(db, alice, bob) == ["1", "2"]
+        key = crud._conversation_cache_key(alice, bob)
+        cached, count = await cache.get_counted_list(key, crud._conversation_count_key(key))
+        assert [message["content"] for message in cached] == ["1", "2"]
+        assert count == 2
+
+        # And back: msgpack values read with JSON
+        await cache.set_cache("msgpack-value", {"a": 1})
+        monkeypatch.setattr(cache, "serializer", cache.get_serializer("json"))
+        assert await cache.get_many_cache(["msgpack-value", "missing"]) == [None, None]
+        assert await cache.redis_client.exists("msgpack-value") == 0
+
+    asyncio.run(scenario())
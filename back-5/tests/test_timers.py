@@ -0,0 +1,40 @@
+import random
+from app.timers import TimingWheel
+
+def test_timers_expire_on_their_tick():
+    wheel = TimingWheel(tick=1.0, slot_bits=2, levels=3, origin=0.0)
+    for timer_id, deadline in [("a", 1), ("b", 3), ("c", 10), ("d", 40), ("e", 63)]:
+        assert wheel.add(timer_id, deadline)
+
+    fired = {}
+    for now in range(64):
+        for timer_id in wheel.advance(now):
+            fired[timer_id] = now
+    assert fired == {"a": 1, "b": 3, "c": 10, "d": 40, "e": 63}
+    assert len(wheel) == 0
+
+def test_overdue_cancelled_and_out_of_range_timers():
+    wheel = TimingWheel(tick=1.0, slot_bits=2, levels=2, origin=0.0)
+    wheel.advance(5)
+    assert wheel.add("late", 2)
+    assert wheel.add("cancelled", 9)
+    assert not wheel.add("cancelled", 9)
+    assert not wheel.add("too far", 5 + 16)
+    assert wheel.cancel("cancelled")
+    assert wheel.advance(5) == ["late"]
+    assert wheel.advance(20) == []
+
+def test_matches_sorted_deadlines():
+    rng = random.Random(7)
+    wheel = TimingWheel(tick=0.1, origin=1000.0)
+    deadlines = {timer_id: 1000.0 + rng.uniform(0, 5000) for timer_id in range(2000)}
+    for timer_id, deadline in deadlines.items():
+        assert wheel.add(timer_id, deadline)
+
+    now = 1000.0
+    while len(wheel):
+        now += rng.uniform(0, 30)
+        for timer_id in wheel.advance(now):
+            # Never early, and fired by the first advance past the deadline
+            assert deadlines[timer_id] <= now + 1e-6
+            assert now - deadlines[timer_id] <= 30 + 0.1
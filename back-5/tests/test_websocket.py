@@ -0,0 +1,52 @@
+import asyncio
+import uvicorn
+from app import server
+from app.config import settings
+from app.websocket import ConnectionManager
+
+class FakeWebSocket:
+    def __init__(self, on_close=None):
+        self.sent = []
+        self.close_code = None
+        self.on_close = on_close
+
+    async def send_json(self, message):
+        self.sent.append(message)
+
+    async def close(self, code=1000):
+        self.close_code = code
+        if self.on_close is not None:
+            await self.on_close()
+
+def test_drain_sends_one_reconnect_frame_each(monkeypatch):
+    monkeypatch.setattr(settings, "DRAIN_BATCH_SIZE", 4)
+    monkeypatch.setattr(settings, "DRAIN_BATCH_INTERVAL_SECONDS", 0)
+    manager = ConnectionManager()
+    # Each endpoint sees its socket close and disconnects while the rest are still open
+    sockets = {user_id: FakeWebSocket(lambda user_id=user_id: manager.disconnect(user_id)) for user_id in range(10)}
+    manager.active_connections.update(sockets)
+
+    asyncio.run(manager.drain())
+    for websocket in sockets.values():
+        assert [message["type"] for message in websocket.sent] == ["reconnect"]
+        assert 0 <= websocket.sent[0]["retry_after_ms"] <= settings.DRAIN_RECONNECT_JITTER_MS
+        assert websocket.close_code == 1012
+    assert manager.active_connections == {}
+
+def test_server_drains_before_uvicorn_closes_connections(monkeypatch):
+    monkeypatch.setattr(settings, "DRAIN_BATCH_SIZE", 4)
+    monkeypatch.setattr(settings, "DRAIN_BATCH_INTERVAL_SECONDS", 0)
+    manager = ConnectionManager()
+    sockets = {user_id: FakeWebSocket() for user_id in range(10)}
+    manager.active_connections.update(sockets)
+    monkeypatch.setattr(server, "manager", manager)
+
+    async def uvicorn_shutdown(self, sockets=None):
+        # uvicorn closes the sockets that are still open; each endpoint then disconnects
+        for user_id in list(manager.active_connections):
+            await manager.disconnect(user_id)
+    monkeypatch.setattr(uvicorn.Server, "shutdown", uvicorn_shutdown)
+
+    asyncio.run(server.Server(uvicorn.Config("app.main:app")).shutdown())
+    for websocket in sockets.values():
+        assert [message["type"] for message in websocket.sent] == ["reconnect"]